@@ -1,62 +1,156 @@
 import io
-import pandas as pd
+import os
+import tempfile
 import streamlit as st
+from climate_store import ClimateStore, SITE_NAME
 from growlights import *
+from jobs import JobPool
+from schedule_io import write_schedule, SCHEDULE_KINDS
+from weather_cache import WeatherCache
+from weather_io import read_climatedata, file_kind
 
 months = "Jan", "Feb", "Mar", "Apr", "May", "June", "July", "Aug", "Sept", "Oct", "Nov", "Dec"
 
+JOB_WORKERS = min(4, os.cpu_count() or 1)
+
 # ---------- Help Functions ---------- #
 
 def clear_results():
     for k in ("results", "error"):
         st.session_state.pop(k, None)
 
-def format_climatedata(raw_data):
-
-    required = [
-        "Local Time",
-        "Temperature (C)",
-        "Solar Radiation (W/m²)"
-    ]
-
-    missing = [c for c in required if c not in raw_data.columns]
-    if missing:
-        raise KeyError(f"Missing required columns: {missing}")
-    
-    dt = pd.to_datetime(raw_data["Local Time"], errors="coerce", utc=False)
-    if dt.isna().any():
-        raise ValueError("Some 'Local Time' values could not be parsed as datetimes.")
-    
-    clean_data = pd.DataFrame({
-        "Year": dt.dt.year.astype("int16"),
-        "Month": dt.dt.month.astype("int8"),
-        "Day": dt.dt.day.astype("int8"),
-        "Hour": dt.dt.hour.astype("int8"),
-        "Temp": pd.to_numeric(raw_data["Temperature (C)"], errors="coerce"),
-        "Isun": pd.to_numeric(raw_data["Solar Radiation (W/m²)"], errors="coerce")
-    })
-
-    if clean_data[["Year", "Month", "Day", "Hour"]].isna().any().any():
-        raise ValueError("Year/Month/Day/Hour could not be derived from 'Local Time'.")
-
-    return clean_data
+def cancel_job():
+    # Stops the calculation of this session (a running job ends at its next model stage)
+    job = st.session_state.pop("job", None)
+    if job is not None and not job.done():
+        job.cancel()
+        st.toast("Calculation cancelled")
+
+def reset_inputs():
+    cancel_job()
+    st.session_state.pop("results", None)
+
+def collect_job():
+    # Moves the result (or error) of a finished calculation into the session state
+    job = st.session_state.get("job")
+    if job is None or not job.done():
+        return
+    del st.session_state["job"]
+    try:
+        st.session_state["results"] = job.result()
+    except Cancelled:
+        pass
+    except Exception as e:
+        st.session_state["error"] = e
+
+@st.cache_resource
+def weather_cache():
+    # One cache of cleaned weather tables shared by all sessions (keyed on the uploaded bytes)
+    return WeatherCache()
+
+@st.cache_resource
+def climate_store():
+    # Weather of the stored sites (memory-mapped, a site is parsed only once when it is saved)
+    return ClimateStore()
+
+@st.cache_resource
+def job_pool():
+    # Worker threads shared by all sessions: at most JOB_WORKERS calculations run at once, later ones wait in line
+    return JobPool(max_workers=JOB_WORKERS)
+
+@st.cache_resource
+def stage_cache():
+    # Model stages shared by all sessions, only the stages whose inputs changed are recomputed
+    return StageCache(maxsize=64)
+
+def read_weather(data, name):
+    # Streams the uploaded file (xlsx, csv or parquet) into the cleaned weather table
+    return read_climatedata(io.BytesIO(data), kind=file_kind(name))
+
+def load_weather(source, timestep, weather_cache, stage_cache, store, progress):
+    # Cleaned weather and its index for the chosen source, returns (weather, index, description)
+    #   source: ("upload", bytes, file name, upload key, name to save the site as or "") or ("site", site, first year, last year)
+    #   an upload is saved only when the site does not already hold it, and not by a job that was cancelled (replaced)
+    if source[0] == "site":
+        _, site, first, last = source
+        weather = store.load(site, first, last)
+        key = ("site", site, first, last, store.info(site)["written"])
+        description = f"Stored site: {site} {first}-{last}"
+    else:
+        _, data, name, key, save_as = source
+        weather = weather_cache.load(data, lambda data: read_weather(data, name), key=key)
+        if save_as and not store.holds(save_as, key):
+            progress.check()
+            store.write(save_as, weather, source=name, key=key)
+        description = "Upload: read and clean weather"
+
+    if weather.empty:
+        raise ValueError("The selected weather has no rows.")
+    index = stage_cache.get(("index", key, timestep), lambda: WeatherIndex(weather, timestep))
+    return weather, index, description
+
+def schedule_file(system, weather, index, params, kind, stage_cache):
+    # Bytes of the hourly lighting schedule (compact columns), only run when the download is clicked; the model
+    # stages come from the stage cache
+    #   Streamlit keeps the whole download in memory: the file is written block by block to a temporary file
+    #   (no CSV string or Parquet buffer next to the schedule) and read back once; server.py /schedule streams it
+    usage = LED_usage if system == "LED" else Hybrid_usage
+    _, schedule = usage(weather, index=index, cache=stage_cache, hourly="compact", **params)
+    with tempfile.TemporaryFile() as f:
+        write_schedule(schedule, f, kind)
+        del schedule
+        f.seek(0)
+        return f.read()
+
+def parse_values(text, cast=float):
+    # Turns "0.2, 0.3, 0.4" into [0.2, 0.3, 0.4] (used for the scenario comparison)
+    values = [cast(v) for v in text.replace(";", ",").split(",") if v.strip()]
+    if not values:
+        raise ValueError(f"No values entered in '{text}'.")
+    return values
 
 # ---------- Main Page ---------- #
 
 st.title("Grow Lights - Average DLI")
 
-system = st.radio("Choose system", ["LED", "Hybrid"], index=0, key="system", on_change=lambda: st.session_state.pop("results", None))
+system = st.radio("Choose system", ["LED", "Hybrid"], index=0, key="system", on_change=reset_inputs)
+mode = st.radio("Mode", ["Single run", "Compare scenarios", "Optimize setpoints"], index=0, key="mode", on_change=reset_inputs)
+
+sites = climate_store().sites()
+source = st.radio("Weather source", ["Upload file", "Stored site"], index=0, key="source", horizontal=True, on_change=reset_inputs)
+if source == "Stored site":
+    site = st.selectbox("Stored site", sites, index=None, placeholder="Save an upload as a site first" if not sites else "Choose a site")
 
 with st.form("controls", clear_on_submit=False):
-    uploaded = st.file_uploader("Upload weather Excel from ksgclimatedata.streamlit.app", type=["xlsx"])
+    if source == "Upload file":
+        uploaded = st.file_uploader("Upload weather file (xlsx, csv or parquet) from ksgclimatedata.streamlit.app", type=["xlsx", "csv", "parquet"])
+        save_as = st.text_input("Save as stored site (optional name)", value="").strip()
+    elif site is not None:
+        # only the rows of the chosen years are read from the store
+        info = climate_store().info(site)
+        first, last = info["first"]//10000, info["last"]//10000
+        years = st.slider("Years", min_value=first, max_value=last, value=(first, last)) if first < last else (first, last)
+    timestep = st.selectbox("Weather timestep", ["Detect from file", "5 min", "10 min", "15 min", "30 min", "60 min"], index=0)
 
     # Take common specifications
     st.header("Common parameters")
-    shade = st.number_input("Shade (fraction)", min_value=0.0, max_value=1.0, value=0.33, step=0.01)
-    start = st.number_input("AL window start hour", min_value=0, max_value=23, value=5, step=1)
-    duration = st.number_input("AL window duration (h)", min_value=1, max_value=24, value=16, step=1)
-    rad_setpoint = st.number_input("Radiation setpoint (W/m²)", min_value=0, value=300, step=10)
-    DLI_target = st.number_input("Target DLI (mol/m²/day)", min_value=0.0, value=30.0, step=0.5)
+    if mode != "Compare scenarios":
+        shade = st.number_input("Shade (fraction)", min_value=0.0, max_value=1.0, value=0.33, step=0.01)
+        if mode == "Single run":
+            start = st.number_input("AL window start hour", min_value=0, max_value=23, value=5, step=1)
+            duration = st.number_input("AL window duration (h)", min_value=1, max_value=24, value=16, step=1)
+            rad_setpoint = st.number_input("Radiation setpoint (W/m²)", min_value=0, value=300, step=10)
+        DLI_target = st.number_input("Target DLI (mol/m²/day)", min_value=0.0, value=30.0, step=0.5)
+        if mode == "Optimize setpoints":
+            # start, duration, radiation setpoint (and Hybrid fixture intensities) are searched -> no inputs
+            tolerance = st.number_input("Allowed monthly DLI shortfall (mol/m²/day)", min_value=0.0, value=1.0, step=0.5)
+    else:
+        # every combination of the entered values is calculated
+        shade = st.text_input("Shade values (fraction, comma separated)", value="0.2, 0.33, 0.5")
+        start = st.text_input("AL window start hours", value="3, 5, 7")
+        duration = st.text_input("AL window durations (h)", value="12, 16, 18")
+        rad_setpoint = st.text_input("Radiation setpoints (W/m²)", value="300")
+        DLI_target = st.text_input("Target DLIs (mol/m²/day)", value="30")
 
     # Take system specification
     if system == "LED":
@@ -69,87 +163,209 @@ with st.form("controls", clear_on_submit=False):
         day_tempsetpoint = st.number_input("Day temp setpoint (°C)", min_value=-30.0, max_value=60.0, value=22.0, step=0.5)
         night_tempsetpoint = st.number_input("Night temp setpoint (°C)", min_value=-30.0, max_value=60.0, value=16.0, step=0.5)
         AL_Intensity = st.number_input("Target AL intensity (µmol/m²/s)", min_value=0.0, value=200.0, step=10.0)
-        LED_Intensity = st.number_input("LED fixture intensity (µmol/m²/s)", min_value=0.0, value=100.0, step=10.0)
+        LED_Intensity = HPS_Intensity = None
+        if mode != "Optimize setpoints":
+            LED_Intensity = st.number_input("LED fixture intensity (µmol/m²/s)", min_value=0.0, value=100.0, step=10.0)
         LED_eff = st.number_input("LED efficacy (µmol/J)", min_value=0.01, value=3.2, step=0.1)
-        HPS_Intensity = st.number_input("HPS fixture intensity (µmol/m²/s)", min_value=0.0, value=100.0, step=10.0)
+        if mode != "Optimize setpoints":
+            HPS_Intensity = st.number_input("HPS fixture intensity (µmol/m²/s)", min_value=0.0, value=100.0, step=10.0)
         HPS_eff = st.number_input("HPS efficacy (µmol/J)", min_value=0.01, value=1.8, step=0.1)
 
+    if mode == "Single run":
+        # percentile bands of the monthly values from resampling the years of the record (0 -> off)
+        draws = st.number_input("Year resampling draws for 5-95% bands (0 = off)", min_value=0, max_value=20000, value=0, step=500)
+    diagnostics = st.checkbox("Record stage diagnostics (time and memory per step)", value=False)
+
     run = st.form_submit_button("Calculate")
 
 # ---------- Run Calculations ---------- #
+
+def calculate(source, timestep, system, mode, common, system_params, draws, weather_cache, stage_cache, store, progress):
+    # Runs on a worker thread (no st.* calls here), returns the results stored in the session state
+    #   progress: ProgressProfile of the job, also passed to the models so every Step/DECISION is reported
+    #   every progress.start() is paired with a stop() in a finally: a failed run must not leave tracing on
+    progress.start()
+    try:
+        # --- Convert weather data to panda table (or read the years of a stored site)
+        weather, index, description = load_weather(source, timestep, weather_cache, stage_cache, store, progress)
+        progress.lap(description, len(weather))
+    finally:
+        progress.stop()
+
+    if mode == "Compare scenarios":
+        # Calculate every combination of the common parameters in one sweep
+        grid = scenario_grid(**common)
+        monthly = sweep_usage(weather, grid, system=system, index=index, profile=progress, **system_params)
+
+        summary = grid.copy()
+        summary["DLI Total (mol/m2/d)"] = (monthly["DLI Solar"] + monthly["DLI AL"]).groupby(monthly["Scenario"]).mean()
+        #   LED "Elec Cons" of a month is summed over all years of the record, Hybrid is already the average month
+        years = index.month_years[index.months.searchsorted(monthly["Month"])] if system == "LED" else 1
+        summary["Elec Cons (kWh/m2/yr)"] = (monthly["Elec Cons (kWh/m2)"] / years).groupby(monthly["Scenario"]).sum()
+
+        return {"system": system, "mode": mode, "monthly": monthly, "summary": summary}
+
+    if mode == "Optimize setpoints":
+        # Search the setpoints with the lowest electricity that keep every month near the target DLI
+        #   the Hybrid fixture intensities are searched (the form has no inputs for them in this mode)
+        search = {k: v for k, v in system_params.items() if k not in ("LED_Intensity", "HPS_Intensity")}
+        front = optimize_setpoints(weather, system=system, index=index, profile=progress, **common, **search)
+
+        return {"system": system, "mode": mode, "front": front}
+
+    # Calculator monthly averages (figures are rendered when displayed)
+    if draws:
+        progress.start()
+        try:
+            monthly = bootstrap_usage(weather, system, draws=draws, index=index, **common, **system_params)
+            progress.lap(f"Year resampling ({draws} draws)", index.n_rows)
+        finally:
+            progress.stop()
+    else:
+        usage = LED_usage if system == "LED" else Hybrid_usage
+        monthly = usage(weather, index=index, cache=stage_cache, profile=progress, **common, **system_params)
+
+    diagnostics = progress.inner.table() if isinstance(progress.inner, StageProfile) else None
+    return {"system": system, "mode": mode, "monthly": monthly, "diagnostics": diagnostics,
+            "schedule": (system, weather, index, {**common, **system_params})}
+
 if run:
+    # A new calculation replaces the one still running for this session
+    cancel_job()
+    clear_results()
     try:
-        if uploaded is not None:
-            # --- Convert weather data to panda table
-            raw = pd.read_excel(uploaded, header=0)
-            weather = format_climatedata(raw)
-
-            if isinstance(weather, pd.DataFrame) and not weather.empty:
-                st.success("✅ Uploaded Excel File")
-            else:
-                st.warning("Error")
-        else:
+        if (uploaded is None) if source == "Upload file" else (site is None):
             st.warning("Please fill all required fields")
             st.stop()
+        if source == "Upload file" and save_as and not SITE_NAME.match(save_as):
+            st.warning("Site names may only use letters, digits, spaces, '.', '_' and '-'")
+            st.stop()
 
         if system == "LED":
-            # Calculator monthly averages and generate the figure
-            monthly = LED_usage(weather,
-                shade=shade, start=start, duration=duration,
-                rad_setpoint=rad_setpoint, GH_tempsetpoint=GH_tempsetpoint,
-                DLI_target=DLI_target, AL_Intensity=AL_Intensity, LED_eff=LED_eff
-            )
-            fig1 = plot_avgDLI(monthly, months)
-            fig2 = barplot_avgDLI(monthly, months)
-
+            system_params = dict(GH_tempsetpoint=GH_tempsetpoint, AL_Intensity=AL_Intensity, LED_eff=LED_eff)
         else:
-            # Calculator monthly averages and generate the figure
-            monthly = Hybrid_usage(weather,
-                shade=shade, start=start, duration=duration,
-                rad_setpoint=rad_setpoint,
+            system_params = dict(
                 day_tempsetpoint=day_tempsetpoint, night_tempsetpoint=night_tempsetpoint,
-                DLI_target=DLI_target, AL_Intensity=AL_Intensity,
-                LED_Intensity=LED_Intensity, LED_eff=LED_eff,
+                AL_Intensity=AL_Intensity, LED_Intensity=LED_Intensity, LED_eff=LED_eff,
                 HPS_Intensity=HPS_Intensity, HPS_eff=HPS_eff
             )
-            fig1 = plot_avgDLI(monthly, months)
-            fig2 = barplot_avgDLI(monthly, months)            
 
-        # Save the results in the session state (so download button does not clear output)
-        st.session_state["results"] = {"system": system, "monthly": monthly, "fig1": fig1, "fig2": fig2}
+        if mode == "Compare scenarios":
+            common = dict(
+                shade=parse_values(shade), start=parse_values(start, int), duration=parse_values(duration, int),
+                rad_setpoint=parse_values(rad_setpoint), DLI_target=parse_values(DLI_target)
+            )
+        elif mode == "Optimize setpoints":
+            # start, duration and rad_setpoint are searched
+            common = dict(shade=shade, DLI_target=DLI_target, tolerance=tolerance)
+        else:
+            common = dict(shade=shade, start=start, duration=duration, rad_setpoint=rad_setpoint, DLI_target=DLI_target)
+
+        if source == "Upload file":
+            data = uploaded.getvalue()
+            weather_source = ("upload", data, uploaded.name, WeatherCache.key(data), save_as)
+        else:
+            weather_source = ("site", site, *years)
+        timestep = None if timestep == "Detect from file" else int(timestep.split()[0])/60      # h per row
+        st.session_state["job"] = job_pool().submit(
+            calculate, weather_source, timestep, system, mode, common, system_params, draws if mode == "Single run" else 0,
+            weather_cache(), stage_cache(), climate_store(), profile=StageProfile() if diagnostics else None
+        )
+        st.success("✅ Uploaded weather file" if source == "Upload file" else f"✅ Stored site {site}")
 
     except Exception as e:
         st.error(f"Something went wrong: {e}")
 
+@st.fragment(run_every=0.5)
+def job_progress():
+    # Polls the running calculation, the whole page is rerun once it has finished
+    job = st.session_state.get("job")
+    if job is None:
+        return
+    if job.done():
+        st.rerun()
+
+    st.info(f"⏳ Calculating... {job.status()}")
+    st.button("Cancel", on_click=cancel_job, key="cancel")
+
+collect_job()
+if "job" in st.session_state:
+    job_progress()
+
 # ---------- Display Output ---------- #
 
 if "error" in st.session_state:
     st.error(f"Something went wrong: {st.session_state['error']}")
 
-if "results" in st.session_state:
+if "results" in st.session_state and st.session_state["results"]["mode"] == "Compare scenarios":
     res = st.session_state["results"]
 
-    # --- Plot figure 1
-    st.pyplot(res["fig1"], width='stretch')
-  
-    buf1 = io.BytesIO()  # creates a virtual container to hold binary data
-    res["fig1"].savefig(buf1, format="png", dpi=300, bbox_inches="tight")  # save the figure data into the binary container
+    # --- Display one summary row per scenario
+    st.dataframe(
+        res["summary"].style.format({
+            "DLI Total (mol/m2/d)": "{:.1f}",
+            "Elec Cons (kWh/m2/yr)": "{:.1f}"
+        }),
+        width="stretch"
+    )
+
+    st.download_button(
+    "Download monthly scenario table (CSV)",
+    data=res["monthly"].to_csv(index=False).encode("utf-8"),
+    file_name=("Monthly_DLI_scenarios.csv"),
+    mime="text/csv",
+    key="csv_scenarios"
+    )
+
+elif "results" in st.session_state and st.session_state["results"]["mode"] == "Optimize setpoints":
+    res = st.session_state["results"]
+    best = res["front"][res["front"]["Best"]]
+
+    if best.empty:
+        st.warning("No setting reaches the target DLI within the allowed shortfall, the table shows the best trade-offs.")
+    else:
+        st.success("Lowest electricity within the allowed shortfall: " + ", ".join(
+            f"{name} = {best.iloc[0][name]:g}" for name in res["front"].columns[:res["front"].columns.get_loc("Elec Cons (kWh/m2/yr)")]
+        ))
+
+    # --- Display the trade-off between electricity and DLI shortfall
+    st.dataframe(
+        res["front"].style.format({
+            "Elec Cons (kWh/m2/yr)": "{:.1f}",
+            "DLI Shortfall (mol/m2/d)": "{:.2f}",
+            "Worst Deficit (mol/m2/d)": "{:.2f}"
+        }),
+        width="stretch"
+    )
+
+    st.download_button(
+    "Download optimization results (CSV)",
+    data=res["front"].to_csv(index=False).encode("utf-8"),
+    file_name=("Setpoint_optimization.csv"),
+    mime="text/csv",
+    key="csv_optimize"
+    )
+
+elif "results" in st.session_state:
+    res = st.session_state["results"]
+
+    # --- Plot figure 1 (rendered once per result, the 300 dpi PNG only when the download is clicked)
+    st.image(figure_png(plot_avgDLI, res["monthly"], months), width="stretch")
+
     st.download_button(
         "Download chart (PNG)",
-        data=buf1.getvalue(),
+        data=lambda: figure_png(plot_avgDLI, res["monthly"], months, dpi=300),
         file_name="AverageDLI.png",
         mime = "image/png",
         key="png"
     )
 
     # --- Plot figure 2
-    st.pyplot(res["fig2"], width='stretch')
+    st.image(figure_png(barplot_avgDLI, res["monthly"], months), width="stretch")
 
-    buf2 = io.BytesIO()  # creates a virtual container to hold binary data
-    res["fig2"].savefig(buf2, format="png", dpi=300, bbox_inches="tight")  # save the figure data into the binary container
     st.download_button(
         "Download chart (PNG)",
-        data=buf2.getvalue(),
+        data=lambda: figure_png(barplot_avgDLI, res["monthly"], months, dpi=300),
         file_name="AverageDLI_barplot.png",
         mime = "image/png",
         key="bar"
@@ -160,7 +376,9 @@ if "results" in st.session_state:
         res["monthly"].style.format({
             "DLI Solar": "{:.1f}",
             "DLI AL": "{:.1f}",
-            "Elec Cons (kWh/m2)": "{:.2f}"
+            "Elec Cons (kWh/m2)": "{:.2f}",
+            **{c: "{:.1f}" for c in res["monthly"].columns if c.startswith(("DLI Total", "DLI Shortfall"))},
+            **{c: "{:.2f}" for c in res["monthly"].columns if c.startswith("Elec Cons p")}
         }),
         width="stretch"
     )
@@ -173,8 +391,34 @@ if "results" in st.session_state:
     key="csv"
     )
 
+    # --- Hourly lighting schedule (made when the download is clicked, held in memory by Streamlit while it is sent)
+    cache = stage_cache()
+    for kind, label in (("parquet", "Parquet"), ("csv", "CSV")):
+        st.download_button(
+            f"Download hourly schedule ({label})",
+            data=lambda kind=kind: schedule_file(*res["schedule"], kind, cache),
+            file_name=f"Hourly_schedule.{kind}",
+            mime=SCHEDULE_KINDS[kind],
+            key=f"schedule_{kind}"
+        )
+
+    # --- Time and memory of each calculation stage (only when diagnostics were recorded)
+    if res["diagnostics"] is not None:
+        with st.expander("Diagnostics"):
+            st.dataframe(
+                res["diagnostics"].style.format({
+                    "Time (s)": "{:.4f}",
+                    "Process memory delta (MB)": "{:.2f}",
+                    "Process memory peak (MB)": "{:.2f}"
+                }),
+                width="stretch"
+            )
+            st.caption("Memory is traced for the whole app process: it includes the calculations of other sessions "
+                       "running at the same time, and tracing slows every running calculation down.")
+
 # ---------- Manual Reset  ---------- #
 
 if st.button("Reset", type="secondary"):
+    cancel_job()
     clear_results()
     st.rerun()
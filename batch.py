@@ -0,0 +1,150 @@
+# PURPOSE #
+# Runs the grow light calculations for many greenhouse sites without the Streamlit form.
+#   Every weather file (xlsx, csv or parquet) in a folder is one site. The sites are spread over a pool of worker
+#   processes: a worker gets only the file path and the scenario config, reads and cleans the weather itself and
+#   sends back the small monthly table, so no large frame is pickled between processes.
+#   All sites are written to one combined monthly table (csv or parquet).
+#
+#   python batch.py sites/ config.json results.csv --workers 8
+#
+#   config.json (every key is optional):
+#   {
+#     "system": "LED",                                  # "LED", "Hybrid" or ["LED", "Hybrid"] to compare both
+#     "fixed": {"DLI_target": 25, "LED_eff": 3.4},      # parameters shared by all scenarios
+#     "timestep": 0.25,                                 # hours per weather row (detected from the file when left out)
+#     "scenarios": {"shade": [0.2, 0.4], "start": [4, 6]}
+#         # dict of lists -> every combination (scenario_grid), list of dicts -> exactly these scenarios
+#   }
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from growlights import WeatherIndex, sweep_usage, scenario_grid
+from weather_cache import WeatherCache
+from weather_io import read_climatedata, file_kind
+
+# ---------- Config ---------- #
+
+def load_config(path):
+    # Reads the scenario config and checks its layout (parameter names are checked by sweep_usage)
+    with open(path) as f:
+        config = json.load(f)
+
+    unknown = [k for k in config if k not in ("system", "fixed", "scenarios", "timestep")]
+    if unknown:
+        raise KeyError(f"Unknown config keys: {unknown}")
+
+    systems = config.get("system", "LED")
+    systems = [systems] if isinstance(systems, str) else list(systems)
+    bad = [s for s in systems if s not in ("LED", "Hybrid")]
+    if bad:
+        raise ValueError(f"Unknown system(s): {bad} (use LED or Hybrid)")
+
+    return {"system": systems, "fixed": config.get("fixed", {}), "scenarios": config.get("scenarios", {}),
+            "timestep": config.get("timestep")}
+
+def scenario_table(scenarios):
+    # dict of lists -> every combination, list of dicts -> one scenario per entry, empty -> one default scenario
+    if isinstance(scenarios, dict):
+        return scenario_grid(**scenarios) if scenarios else pd.DataFrame(index=[0])
+    return pd.DataFrame(scenarios)
+
+def find_sites(folder):
+    # {site name: path} for every weather file in the folder (site name = file name without extension)
+    sites = {}
+    for name in sorted(os.listdir(folder)):
+        try:
+            file_kind(name)
+        except ValueError:
+            continue
+        site = os.path.splitext(name)[0]
+        if site in sites:
+            raise ValueError(f"Two weather files for site '{site}' in {folder}")
+        sites[site] = os.path.join(folder, name)
+    return sites
+
+# ---------- Worker ---------- #
+
+def read_site(path, cache_dir=None):
+    # Cleaned weather of one site, the Parquet weather cache skips the parsing on later runs
+    if cache_dir is None:
+        return read_climatedata(path)
+
+    with open(path, "rb") as f:
+        data = f.read()
+    return WeatherCache(cache_dir, max_entries=1).load(data, lambda _: read_climatedata(path))
+
+def run_site(site, path, config, cache_dir=None):
+    # Monthly table of every system and scenario for one site (runs in a worker process)
+    weather = read_site(path, cache_dir)
+    index = WeatherIndex(weather, config["timestep"])
+    scenarios = scenario_table(config["scenarios"])
+
+    tables = []
+    for system in config["system"]:
+        monthly = sweep_usage(weather, scenarios, system=system, index=index, **config["fixed"])
+        monthly.insert(0, "System", system)
+        tables.append(monthly)
+
+    monthly = pd.concat(tables, ignore_index=True)
+    monthly.insert(0, "Site", site)
+    return monthly
+
+def run(sites, config, workers=None, cache_dir=None):
+    # Runs every site in a process pool, returns (combined monthly table in site order, {site: error message})
+    results, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_site, site, path, config, cache_dir): site for site, path in sites.items()}
+        for future in as_completed(futures):
+            site = futures[future]
+            try:
+                results[site] = future.result()
+                print(f"{site}: done", flush=True)
+            except Exception as e:
+                errors[site] = f"{type(e).__name__}: {e}"
+                print(f"{site}: failed ({errors[site]})", file=sys.stderr, flush=True)
+
+    tables = [results[site] for site in sites if site in results]
+    combined = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    return combined, errors
+
+def write_table(table, path):
+    if os.path.splitext(path)[1].lower() == ".parquet":
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
+
+# ---------- Command line ---------- #
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the grow light calculations for every weather file in a folder")
+    parser.add_argument("sites", help="folder with one weather file (xlsx, csv or parquet) per site")
+    parser.add_argument("config", nargs="?", help="JSON scenario config (default: LED with the default parameters)")
+    parser.add_argument("output", nargs="?", default="batch_results.csv", help="combined monthly table (.csv or .parquet)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: number of CPUs)")
+    parser.add_argument("--cache-dir", help="keep the cleaned weather as Parquet here to skip parsing on later runs")
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    config = load_config(args.config) if args.config else {"system": ["LED"], "fixed": {}, "scenarios": {}, "timestep": None}
+    sites = find_sites(args.sites)
+    if not sites:
+        parser.error(f"no xlsx, csv or parquet files in {args.sites}")
+
+    t0 = time.perf_counter()
+    combined, errors = run(sites, config, min(args.workers, len(sites)), args.cache_dir)
+    if not combined.empty:
+        write_table(combined, args.output)
+
+    print(f"{len(sites) - len(errors)}/{len(sites)} sites in {time.perf_counter() - t0:.1f} s -> {args.output}")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
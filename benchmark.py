@@ -0,0 +1,162 @@
+# PURPOSE #
+# Measures how the calculations scale with the length of the weather record.
+#   A deterministic synthetic hourly record (diurnal + seasonal shape) is generated for each size, every function
+#   is timed and its peak memory is traced. Results can be saved as a baseline and later runs compared against it.
+#
+#   python benchmark.py --years 1 5 10                     # print the table
+#   python benchmark.py --years 1 10 --save baseline.json  # keep the results as a baseline
+#   python benchmark.py --years 1 10 --compare baseline.json --time-threshold 1.3
+#       -> exits with status 1 if any function got slower (or uses more memory) than the thresholds allow
+#   python benchmark.py --years 5 --step-minutes 15         # sub-hourly weather (4x the rows)
+import argparse
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from growlights import (WeatherIndex, StageCache, LED_usage, Hybrid_usage, sweep_usage, stream_usage, scenario_grid,
+                        plot_avgDLI, barplot_avgDLI)
+from weather_io import format_climatedata, read_climatedata, iter_climatedata
+
+months = "Jan", "Feb", "Mar", "Apr", "May", "June", "July", "Aug", "Sept", "Oct", "Nov", "Dec"
+
+# ---------- Synthetic weather ---------- #
+
+def synthetic_raw(years=1, seed=0, start_year=2000, step_minutes=60):
+    # Raw weather (same columns as the uploaded Excel) for a number of years, one row every step_minutes
+    #   Isun: half sine between sunrise and sunset, day length and peak follow the season, random cloud cover
+    #   Temp: seasonal mean + daily cycle peaking in the afternoon + noise
+    rng = np.random.default_rng(seed)
+    time_index = pd.date_range(f"{start_year}-01-01", f"{start_year + years}-01-01", freq=f"{step_minutes}min", inclusive="left")
+    rows_per_day = 24*60//step_minutes
+
+    hour = time_index.hour.to_numpy() + time_index.minute.to_numpy()/60
+    season = np.cos(2*np.pi*(time_index.dayofyear.to_numpy() - 172)/365.25)    # 1 in June, -1 in December
+
+    day_length = 12 + 4*season                                                   # h
+    solar_time = (hour - (12 - day_length/2)) / day_length                      # 0 at sunrise, 1 at sunset
+    clouds = np.repeat(rng.uniform(0.3, 1.0, len(time_index)//rows_per_day + 1), rows_per_day)[:len(time_index)]
+    Isun = np.where((solar_time > 0) & (solar_time < 1), np.sin(np.pi*solar_time), 0) * (550 + 350*season) * clouds
+
+    temp = 10 + 12*season + 5*np.sin(2*np.pi*(hour - 9)/24) + rng.normal(0, 2, len(time_index))
+
+    return pd.DataFrame({
+        "Local Time": time_index,
+        "Temperature (C)": temp.round(1),
+        "Solar Radiation (W/m²)": Isun.round(1)
+    })
+
+def synthetic_weather(years=1, seed=0, start_year=2000, step_minutes=60):
+    # Cleaned weather (output of format_climatedata) for a number of years
+    return format_climatedata(synthetic_raw(years, seed, start_year, step_minutes))
+
+# ---------- Benchmarks ---------- #
+
+def render(plot, monthly):
+    fig = plot(monthly, months)
+    fig.savefig(io.BytesIO(), format="png", dpi=300, bbox_inches="tight")
+    plt.close(fig)
+
+def benchmarks(years, step_minutes=60):
+    # Returns {name: (callable, rows processed)} for one size of weather record
+    raw = synthetic_raw(years, step_minutes=step_minutes)
+    weather = format_climatedata(raw)
+    csv = raw.to_csv(index=False).encode("utf-8")
+    monthly = LED_usage(weather)
+    grid = scenario_grid(shade=[0.2, 0.3, 0.4, 0.5], start=[3, 5, 7], duration=[12, 16, 18], rad_setpoint=[200, 300])
+
+    #   the app case: index and SolarSummary are cached, only shade / rad_setpoint change
+    index, cache = WeatherIndex(weather), StageCache()
+    LED_usage(weather, index=index, cache=cache)
+
+    rows = len(weather)
+    return {
+        "format_climatedata": (lambda: format_climatedata(raw), rows),
+        "read_climatedata (csv)": (lambda: read_climatedata(io.BytesIO(csv), kind="csv"), rows),
+        "stream_usage LED (csv)": (lambda: stream_usage(iter_climatedata(io.BytesIO(csv), kind="csv")), rows),
+        "LED_usage": (lambda: LED_usage(weather), rows),
+        "Hybrid_usage": (lambda: Hybrid_usage(weather), rows),
+        "LED_usage (cached, new shade)": (lambda: LED_usage(weather, shade=0.4, index=index, cache=cache), rows),
+        f"sweep_usage LED ({len(grid)} scenarios)": (lambda: sweep_usage(weather, grid, system="LED"), rows),
+        f"sweep_usage Hybrid ({len(grid)} scenarios)": (lambda: sweep_usage(weather, grid, system="Hybrid"), rows),
+        "plot_avgDLI (300 dpi)": (lambda: render(plot_avgDLI, monthly), len(monthly)),
+        "barplot_avgDLI (300 dpi)": (lambda: render(barplot_avgDLI, monthly), len(monthly)),
+    }
+
+def measure(func, repeat=3):
+    # Best wall time of repeat runs (s) and peak traced memory of one extra run (MB)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak/1e6
+
+def run(years_list, repeat=3, only=None, step_minutes=60):
+    results = []
+    for years in years_list:
+        for name, (func, rows) in benchmarks(years, step_minutes).items():
+            if only and not any(o in name for o in only):
+                continue
+            seconds, peak_MB = measure(func, repeat)
+            results.append({"function": name, "years": years, "rows": rows, "seconds": seconds, "peak_MB": peak_MB})
+            print(f"{name:<36} {years:>3} y {rows:>9} rows {seconds:>9.4f} s {peak_MB:>9.1f} MB", flush=True)
+    return pd.DataFrame(results)
+
+def compare(results, baseline, time_threshold=1.25, memory_threshold=1.25):
+    # Joins the results with a baseline and flags every function/size that exceeds the thresholds (ratio to baseline)
+    #   rows is part of the join: a run with another --step-minutes has no baseline instead of a false regression
+    table = results.merge(baseline, on=["function", "years", "rows"], how="left", suffixes=("", " baseline"))
+    table["time ratio"] = table["seconds"] / table["seconds baseline"]
+    table["memory ratio"] = table["peak_MB"] / table["peak_MB baseline"]
+    table["regression"] = (table["time ratio"] > time_threshold) | (table["memory ratio"] > memory_threshold)
+    return table
+
+# ---------- Command line ---------- #
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the grow light calculations on synthetic weather")
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5, 10], help="record lengths to test (1-50 years)")
+    parser.add_argument("--step-minutes", type=int, default=60, choices=[5, 10, 15, 20, 30, 60], help="minutes between weather rows")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per function (best is kept)")
+    parser.add_argument("--only", nargs="+", help="only run functions whose name contains one of these")
+    parser.add_argument("--save", help="write the results to this JSON baseline")
+    parser.add_argument("--compare", help="compare against this JSON baseline")
+    parser.add_argument("--time-threshold", type=float, default=1.25, help="allowed time ratio to the baseline")
+    parser.add_argument("--memory-threshold", type=float, default=1.25, help="allowed peak memory ratio to the baseline")
+    args = parser.parse_args(argv)
+
+    if not all(1 <= y <= 50 for y in args.years):
+        parser.error("--years must be between 1 and 50")
+
+    results = run(args.years, args.repeat, args.only, args.step_minutes)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results.to_dict(orient="records"), f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = pd.DataFrame(json.load(f))[["function", "years", "rows", "seconds", "peak_MB"]]
+        table = compare(results, baseline, args.time_threshold, args.memory_threshold)
+        print()
+        print(table[["function", "years", "rows", "time ratio", "memory ratio", "regression"]].to_string(index=False, float_format="{:.2f}".format))
+        if table["regression"].any():
+            print("\nPerformance regression above the thresholds", file=sys.stderr)
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+# PURPOSE #
+# Local on-disk store of cleaned weather, one folder per site, so a site is parsed once and then opens instantly.
+#   Every column of the cleaned table is a fixed dtype .npy file, rows in chronological order, opened memory-mapped:
+#   only the rows of the requested date range are read from disk.
+#   A per-day index (YYYYMMDD of each day and its first row) turns a date range into one contiguous slice of rows.
+#
+#   <root>/<site>/Year.npy, Month.npy, ... Isun.npy    columns (COLUMNS dtypes)
+#   <root>/<site>/days.npy, day_starts.npy            date index
+#   <root>/<site>/meta.json                           rows, first/last day, timestep, source file (and its content
+#                                                     key), write time
+#
+#   python climate_store.py add ithaca weather/ithaca.xlsx     # parse once and store as site "ithaca"
+#   python climate_store.py list
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from growlights import infer_timestep
+from weather_io import read_climatedata
+
+COLUMNS = {
+    "Year": "int16",
+    "Month": "int8",
+    "Day": "int8",
+    "Hour": "int8",
+    "Minute": "int8",
+    "Temp": "float64",
+    "Isun": "float64",
+}
+
+SITE_NAME = re.compile(r"^[\w][\w .-]*$")
+SWAP_ATTEMPTS = 10      # renames of a written site into place while other writers of the site keep swapping theirs in
+
+def day_stamp(value, end=False):
+    # YYYYMMDD of a date ("2015-06-01", Timestamp, ...), a year alone (2015 or "2015") means its first (or with
+    # end=True its last) day
+    if isinstance(value, str) and re.fullmatch(r"\s*\d{4}\s*", value):
+        value = int(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)*10000 + (1231 if end else 101)
+    date = pd.Timestamp(value)
+    return date.year*10000 + date.month*100 + date.day
+
+class ClimateStore:
+
+    def __init__(self, root="climate_store"):
+        self.root = root
+
+    def sites(self):
+        # Names of the stored sites (sorted)
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(s for s in os.listdir(self.root)
+                      if not s.endswith((".tmp", ".old")) and os.path.exists(os.path.join(self.root, s, "meta.json")))
+
+    def info(self, site):
+        with open(os.path.join(self._folder(site), "meta.json")) as f:
+            return json.load(f)
+
+    def holds(self, site, key):
+        # True when site was written from the source with content key (e.g. the hash of an uploaded file)
+        try:
+            return key is not None and self.info(site).get("key") == key
+        except (OSError, ValueError):
+            return False
+
+    def write(self, site, weather, source=None, key=None):
+        # Stores a cleaned weather table (format_climatedata / read_climatedata output) as site, replacing an older copy
+        #   rows are put in chronological order (by day, hour and minute)
+        #   key: content key of the source, kept in meta.json (see holds)
+        #   several writers of one site may run at once (threads or processes), the last one to finish is kept
+        missing = [c for c in COLUMNS if c not in weather and c != "Minute"]
+        if missing:
+            raise KeyError(f"Missing weather columns: {missing}")
+        if weather.empty:
+            raise ValueError("The weather table has no rows.")
+
+        stamp = (weather["Year"].to_numpy(dtype="int64")*100 + weather["Month"].to_numpy(dtype="int64"))*100 + weather["Day"].to_numpy(dtype="int64")
+        minute = weather["Hour"].to_numpy(dtype="int64")*60 + (weather["Minute"].to_numpy(dtype="int64") if "Minute" in weather else 0)
+        order = np.argsort(stamp*1440 + minute, kind="stable")
+        stamp, minute = stamp[order], minute[order]
+
+        new_day = np.ones(len(stamp), dtype=bool)
+        new_day[1:] = stamp[1:] != stamp[:-1]
+        day_starts = np.flatnonzero(new_day)
+
+        folder = self._folder(site)
+        os.makedirs(self.root, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=f"{site}.", suffix=".tmp", dir=self.root)
+
+        for column, dtype in COLUMNS.items():
+            values = weather[column].to_numpy(dtype=dtype, na_value=np.nan) if column in weather else np.zeros(len(weather), dtype=dtype)
+            np.save(os.path.join(tmp, f"{column}.npy"), values[order])
+        np.save(os.path.join(tmp, "days.npy"), stamp[day_starts].astype("int32"))
+        np.save(os.path.join(tmp, "day_starts.npy"), day_starts.astype("int64"))
+
+        meta = {
+            "site": site,
+            "rows": int(len(stamp)),
+            "days": int(len(day_starts)),
+            "first": int(stamp[0]),
+            "last": int(stamp[-1]),
+            "timestep": float(infer_timestep(minute, new_day)),
+            "source": source,
+            "key": key,
+            "written": time.time(),
+        }
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        # swap the complete folder in (readers never see a half written site)
+        #   another writer may swap its copy in between the two renames -> move that one aside as well and retry
+        old = tmp[:-len(".tmp")] + ".old"
+        for attempt in range(SWAP_ATTEMPTS):
+            try:
+                os.replace(folder, old)
+            except FileNotFoundError:
+                pass
+            try:
+                os.replace(tmp, folder)
+                return meta
+            except OSError:
+                if attempt == SWAP_ATTEMPTS - 1:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    raise
+            finally:
+                shutil.rmtree(old, ignore_errors=True)
+
+    def load(self, site, start=None, end=None):
+        # Cleaned weather table of a site between start and end (inclusive dates or years, None -> first/last day)
+        #   the columns are read-only views on the memory-mapped files, only the selected rows are read
+        folder = self._folder(site)
+        if not os.path.exists(os.path.join(folder, "meta.json")):
+            raise KeyError(f"Unknown site: '{site}'")
+
+        days = np.load(os.path.join(folder, "days.npy"))
+        day_starts = np.load(os.path.join(folder, "day_starts.npy"))
+        first = 0 if start is None else int(np.searchsorted(days, day_stamp(start), side="left"))
+        last = len(days) if end is None else int(np.searchsorted(days, day_stamp(end, end=True), side="right"))
+
+        columns = {column: np.load(os.path.join(folder, f"{column}.npy"), mmap_mode="r") for column in COLUMNS}
+        r0 = day_starts[first] if first < len(days) else len(columns["Year"])
+        r1 = day_starts[last] if last < len(days) else len(columns["Year"])
+        return pd.DataFrame({column: values[r0:max(r0, r1)] for column, values in columns.items()}, copy=False)
+
+    def remove(self, site):
+        shutil.rmtree(self._folder(site))
+
+    def _folder(self, site):
+        if not SITE_NAME.match(site) or site.endswith((".tmp", ".old")):
+            raise ValueError(f"Invalid site name: '{site}' (letters, digits, space, '.', '_' and '-')")
+        return os.path.join(self.root, site)
+
+# ---------- Command line ---------- #
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the local climate store")
+    parser.add_argument("--root", default="climate_store", help="folder of the store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="parse a weather file (xlsx, csv or parquet) and store it as a site")
+    add.add_argument("site")
+    add.add_argument("path")
+    commands.add_parser("list", help="list the stored sites")
+    remove = commands.add_parser("remove", help="delete a stored site")
+    remove.add_argument("site")
+    args = parser.parse_args(argv)
+
+    store = ClimateStore(args.root)
+    if args.command == "add":
+        meta = store.write(args.site, read_climatedata(args.path), source=os.path.basename(args.path))
+        print(f"{args.site}: {meta['rows']} rows, {meta['first']} - {meta['last']}")
+    elif args.command == "list":
+        for site in store.sites():
+            meta = store.info(site)
+            print(f"{site:<24} {meta['first']} - {meta['last']} {meta['rows']:>9} rows  timestep {meta['timestep']:g} h")
+    else:
+        store.remove(args.site)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
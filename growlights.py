@@ -1,10 +1,503 @@
 # PURPOSE #
-# This function returns a modified weather dataframe with additional columns: 
+# These functions calculate the average monthly DLI and electricity use of grow lights from an hourly (or sub-hourly) weather dataframe (the dataframe itself is not modified)
+import functools
+import hashlib
+import inspect
+import io
+import itertools
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
 # -------- Calculation functions -------- #
 
-def LED_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, GH_tempsetpoint=22, DLI_target=30, AL_Intensity = 200, LED_eff = 3.2):
+class DayBlock:
+    # Rows of whole days in chronological order: the hourly arrays and the day layout used by the hourly stages
+    #   timestep: hours covered by one row (1 for hourly weather, 0.25 for 15 minute weather, ...)
+    #   "hourly" arrays hold one value per row, whatever the timestep
+
+    def __init__(self, hour, temp, Isun, day_starts, timestep):
+        self.hour, self.temp, self.Isun = hour, temp, Isun
+        self.n_rows = len(hour)
+        self.timestep = timestep
+
+        #   day blocks: first row of each day, day number of each row, rows per day
+        self.day_starts = day_starts
+        self.day_rows = np.diff(np.append(day_starts, self.n_rows))
+        self.day = np.repeat(np.arange(len(day_starts)), self.day_rows)
+
+        #   daily solar sum (W/m2 integrated over the rows of the day, in W.h/m2, missing Isun counts as 0)
+        self.day_Isun = self.timestep*self.daily_sum(np.where(np.isnan(Isun), 0, Isun))
+
+    def daily_sum(self, hourly):
+        return np.add.reduceat(hourly, self.day_starts, axis=0)
+
+    def hourly(self, daily):
+        # Repeats a daily value for each row of the day
+        return daily[self.day]
+
+class MonthLayout:
+    # Month layout of a chronological list of days (day_stamp = YYYYMMDD of each day)
+
+    def __init__(self, day_stamp, month_dtype="int8"):
+        self.day_stamp = day_stamp
+
+        #   month blocks (Year, Month): first day of each month, month block of each day
+        day_ym = day_stamp // 100
+        new_ym = np.ones(len(day_ym), dtype=bool)
+        new_ym[1:] = day_ym[1:] != day_ym[:-1]
+        self.ym_starts = np.flatnonzero(new_ym)
+        self.day_ym = np.cumsum(new_ym) - 1
+
+        #   calendar months (Jan..Dec) present in the data, used for the multi-year monthly table
+        day_month = (day_ym % 100).astype(month_dtype)
+        self.months, self.day_month = np.unique(day_month, return_inverse=True)
+        self.month_of = np.eye(len(self.months))[self.day_month].T   # months x days (one-hot)
+        self.month_years = np.bincount(self.day_month[self.ym_starts], minlength=len(self.months))   # years covering each month
+
+    def year_month_sum(self, daily):
+        return np.add.reduceat(daily, self.ym_starts, axis=0)
+
+    def month_sum(self, daily):
+        return self.month_of @ daily
+
+    def month_mean(self, daily, weights=None):
+        # Mean over the days of each calendar month (days weighted by weights, e.g. their number of rows)
+        weights = np.ones(len(self.day_month)) if weights is None else weights
+        return (self.month_of*weights) @ daily / (self.month_of @ weights).reshape(-1, *[1]*(np.ndim(daily)-1))
+
+    def month_std(self, daily, weights=None):
+        # Sample standard deviation (ddof=1) over the days of each calendar month
+        weights = np.ones(len(self.day_month)) if weights is None else weights
+        n = (self.month_of @ weights).reshape(-1, *[1]*(np.ndim(daily)-1))
+        deviation = daily - self.month_mean(daily, weights)[self.day_month]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.sqrt((self.month_of*weights) @ deviation**2 / (n - 1))
+
+class WeatherIndex(DayBlock, MonthLayout):
+    # Day and month layout of a weather table, built once per dataset and shared by all calculations
+    #   hourly arrays are kept in chronological order so that every day and every (Year, Month) is one
+    #   contiguous block of rows -> daily/monthly sums are segment reductions instead of repeated groupby
+    #   timestep: hours per row, taken from the most common step between the times of a day when not given
+
+    def __init__(self, weather, timestep=None):
+        stamp = (weather["Year"].to_numpy(dtype="int64")*100 + weather["Month"].to_numpy(dtype="int64"))*100 + weather["Day"].to_numpy(dtype="int64")
+
+        #   order: rows sorted by day and time of day (None when the table is already in chronological order),
+        #   the time must be part of the key: the timestep is inferred from the steps between the rows of a day
+        minute = minute_of_day(weather)
+        self.order = None
+        if (np.diff(stamp*1440 + minute) < 0).any():
+            self.order = np.argsort(stamp*1440 + minute, kind="stable")
+            stamp = stamp[self.order]
+
+        new_day = np.ones(len(stamp), dtype=bool)
+        new_day[1:] = stamp[1:] != stamp[:-1]
+        if timestep is None:
+            timestep = infer_timestep(self.sorted(minute), new_day)
+
+        DayBlock.__init__(self, *(self.sorted(a) for a in weather_arrays(weather)), np.flatnonzero(new_day), float(timestep))
+        MonthLayout.__init__(self, stamp[self.day_starts], weather["Month"].dtype)
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        # Content hash of the indexed weather (used in the StageCache keys)
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for values in (self.hour, self.temp, self.Isun, self.day_starts, self.ym_starts, self.months, self.timestep):
+                digest.update(np.ascontiguousarray(values).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def sorted(self, values):
+        # Hourly values in chronological order
+        return values if self.order is None else values[self.order]
+
+    def rows(self, values):
+        # Hourly values back in the row order of the weather table
+        if self.order is None:
+            return values
+        out = np.empty_like(values)
+        out[self.order] = values
+        return out
+
+    def block(self, first_day, last_day):
+        # Rows of the days [first_day, last_day) as a DayBlock (views, nothing is copied)
+        r0 = self.day_starts[first_day]
+        r1 = self.day_starts[last_day] if last_day < len(self.day_starts) else self.n_rows
+        return DayBlock(self.hour[r0:r1], self.temp[r0:r1], self.Isun[r0:r1], self.day_starts[first_day:last_day] - r0, self.timestep)
+
+    def blocks(self, max_rows):
+        # Splits the days into consecutive DayBlocks of at most max_rows rows (a longer day is a block of its own)
+        #   yields (first day, DayBlock)
+        day_ends = self.day_starts + self.day_rows
+        first = 0
+        while first < len(self.day_starts):
+            last = max(int(np.searchsorted(day_ends, self.day_starts[first] + max_rows, side="right")), first + 1)
+            yield first, self.block(first, last)
+            first = last
+
+class SolarSummary:
+    # Per-day solar values of one AL window and temperature setpoint, so Max AL Hours for any shade and
+    # rad_setpoint is a lookup per day instead of a pass over every row (Natural DLI already only needs day_Isun)
+    #   rows of the window that are not warm and sunny (and have a known Isun) can only still be ruled out by the
+    #   radiation setpoint: their Isun values are kept sorted per day, as ranks in the sorted values of all days
+    #   block: WeatherIndex or DayBlock, shade <= 1
+
+    def __init__(self, block, start, duration, tempsetpoint):
+        self.timestep = block.timestep
+        hour, temp, Isun = block.hour, block.temp, block.Isun
+        n_days = len(block.day_starts)
+
+        in_window = (hour >= start) & (hour < (start+duration+1)) & ~np.isnan(Isun)
+        candidate = in_window & ~((temp > tempsetpoint) & (Isun != 0))
+
+        #   rows of the window per day (at shade = 1 the inside radiation is 0 and no hour is too warm)
+        self.window_rows = np.bincount(block.day[in_window], minlength=n_days)
+
+        #   sorted Isun of all days, and per day the sorted ranks (day*rows + rank, one increasing key array)
+        day, values = block.day[candidate], Isun[candidate]
+        self.values = np.sort(values)
+        self.keys = np.sort(day*len(values) + np.searchsorted(self.values, values))
+        self.day_keys = np.arange(n_days)*len(values)
+        self.first = np.searchsorted(self.keys, self.day_keys)
+
+    def max_hours(self, shade, rad_setpoint):
+        # Daily "Max AL Hours" (days, or days x n when shade / rad_setpoint are arrays of n values)
+        #   rank of the first Isun with 0.8*(1-shade)*Isun >= rad_setpoint (same test as AL_mask), then per day the
+        #   number of its values below that rank
+        factor, rad_setpoint = np.broadcast_arrays(0.8*(1-np.asarray(shade, dtype="float64")), np.asarray(rad_setpoint, dtype="float64"))
+        rank = self.threshold_rank(factor.ravel(), rad_setpoint.ravel())
+
+        count = np.searchsorted(self.keys, self.day_keys[:, None] + rank) - self.first[:, None]
+        count = np.where(factor.ravel() == 0, np.where(0 < rad_setpoint.ravel(), self.window_rows[:, None], 0), count)
+        return self.timestep*count.reshape(-1, *factor.shape)
+
+    def threshold_rank(self, factor, rad_setpoint):
+        # Number of sorted values with factor*Isun < rad_setpoint: searchsorted on rad_setpoint/factor, then moved
+        # by the exact product test where the division rounded differently
+        n = len(self.values)
+        if n == 0:
+            return np.zeros(len(factor), dtype="int64")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rank = np.searchsorted(self.values, np.where(factor > 0, rad_setpoint/np.where(factor > 0, factor, 1), 0))
+
+        below = lambda i: factor*self.values[np.clip(i, 0, n - 1)] < rad_setpoint
+        while True:
+            back = (factor > 0) & (rank > 0) & ~below(rank - 1)
+            if not back.any():
+                break
+            rank -= back
+        while True:
+            ahead = (factor > 0) & (rank < n) & below(rank)
+            if not ahead.any():
+                break
+            rank += ahead
+        return rank
+
+class StageProfile:
+    # Opt-in diagnostics of the model stages: pass profile=StageProfile() to LED_usage / Hybrid_usage
+    #   each stage records its wall time (s), the rows it processed and its memory delta/peak (MB, tracemalloc)
+    #   the models call start() once, lap() at the end of every "Step"/"DECISION" and stop() before returning
+    #   tracemalloc traces the whole process: with runs in other threads the memory columns include their
+    #   allocations, and tracing is shared, started by the first recording profile and stopped by the last one
+
+    _tracing_lock = threading.Lock()
+    _tracing_users = 0          # StageProfiles recording memory right now
+    _own_tracing = False        # tracing was started by a StageProfile (not by the caller)
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.stages = []
+        self._tracing = False
+        self._memory = 0
+
+    def start(self):
+        if self.memory and not self._tracing:
+            with StageProfile._tracing_lock:
+                if StageProfile._tracing_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    StageProfile._own_tracing = True
+                StageProfile._tracing_users += 1
+            self._tracing = True
+        self._reset()
+
+    def lap(self, stage, rows):
+        seconds = time.perf_counter() - self._time
+        memory, peak = tracemalloc.get_traced_memory() if self.memory else (0, 0)
+        self.stages.append({
+            "Stage": stage,
+            "Rows": rows,
+            "Time (s)": seconds,
+            "Process memory delta (MB)": (memory - self._memory)/1e6,
+            "Process memory peak (MB)": max(peak - self._memory, 0)/1e6
+        })
+        self._reset()
+
+    def stop(self):
+        if self._tracing:
+            with StageProfile._tracing_lock:
+                StageProfile._tracing_users -= 1
+                if StageProfile._tracing_users == 0 and StageProfile._own_tracing:
+                    tracemalloc.stop()
+                    StageProfile._own_tracing = False
+            self._tracing = False
+
+    def check(self):
+        pass
+
+    def table(self):
+        return pd.DataFrame(self.stages, columns=["Stage", "Rows", "Time (s)", "Process memory delta (MB)", "Process memory peak (MB)"])
+
+    def _reset(self):
+        if self.memory:
+            tracemalloc.reset_peak()
+            self._memory = tracemalloc.get_traced_memory()[0]
+        self._time = time.perf_counter()
+
+class NoProfile:
+    # Stand-in used when no profile is requested (every call is a no-op)
+    def start(self):
+        pass
+
+    def lap(self, stage, rows):
+        pass
+
+    def stop(self):
+        pass
+
+    def check(self):
+        pass
+
+NO_PROFILE = NoProfile()
+
+def stops_profile(func):
+    # Stops the profile= of a model function however the run ends: an error must not leave a StageProfile
+    # recording (tracemalloc would stay on for the whole process); stop() may be called more than once
+    @functools.wraps(func)
+    def run(*args, profile=None, **kwargs):
+        try:
+            return func(*args, profile=profile, **kwargs)
+        finally:
+            if profile is not None:
+                profile.stop()
+    return run
+
+class NestedProfile(NoProfile):
+    # Profile of a run inside another profiled run (e.g. the sweeps of optimize_setpoints): records nothing,
+    # only lets the outer run be cancelled at every inner stage
+    def __init__(self, outer):
+        self.outer = outer
+
+    def lap(self, stage, rows):
+        self.outer.check()
+
+class Cancelled(Exception):
+    # Raised at the next stage of a run whose ProgressProfile was cancelled
+    pass
+
+class ProgressProfile:
+    # Progress of a run in another thread: pass profile=ProgressProfile() to the models, sweep_usage or optimize_setpoints
+    #   stage (last finished stage) and done (number of finished stages) can be read from any thread
+    #   cancel() makes the run raise Cancelled at its next stage
+    #   inner: StageProfile that still records the diagnostics of the run
+
+    def __init__(self, inner=None):
+        self.inner = NO_PROFILE if inner is None else inner
+        self.stage, self.done = "Waiting", 0
+        self._cancelled = threading.Event()
+
+    def start(self):
+        self.check()
+        if self.done == 0:
+            self.stage = "Started"
+        self.inner.start()
+
+    def lap(self, stage, rows):
+        self.inner.lap(stage, rows)
+        self.stage, self.done = stage, self.done + 1
+        self.check()
+
+    def stop(self):
+        self.inner.stop()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self.cancelled:
+            self.inner.stop()
+            raise Cancelled("The calculation was cancelled.")
+
+class StageCache:
+    # Bounded memo of model stages, keyed on the weather fingerprint and only the parameters a stage depends on
+    #   e.g. a new LED_eff does not change the AL hours or the light dispatch, only the electricity is recomputed
+    #   pass cache=StageCache() to LED_usage / Hybrid_usage (least recently used stages are evicted)
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        # Returns the stored result of a stage, compute() is only called when the key is not stored
+        value = self.lookup(key)
+        if value is None:
+            value = compute()
+            self.store(key, value)
+        return value
+
+    def lookup(self, key):
+        # Stored result of a stage (None when it is not stored)
+        with self._lock:
+            if key in self._stages:
+                self._stages.move_to_end(key)
+                return self._stages[key]
+        return None
+
+    def store(self, key, value):
+        with self._lock:
+            self._stages[key] = value
+            self._stages.move_to_end(key)
+            while len(self._stages) > self.maxsize:
+                self._stages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._stages.clear()
+
+def memo(cache, key, compute):
+    # Runs a model stage through the cache (or directly when no cache is used)
+    return compute() if cache is None else cache.get(key, compute)
+
+def weather_fingerprint(weather):
+    # Content hash of the weather columns used by the models
+    digest = hashlib.sha1()
+    for column in ("Year", "Month", "Day", "Hour", "Minute", "Temp", "Isun"):
+        if column in weather:
+            digest.update(np.ascontiguousarray(weather[column].to_numpy()).tobytes())
+    return digest.hexdigest()
+
+def minute_of_day(weather):
+    # Minutes since midnight of every row ("Minute" is optional, tables without it are hourly)
+    minute = weather["Hour"].to_numpy(dtype="int64")*60
+    if "Minute" in weather:
+        minute = minute + weather["Minute"].to_numpy(dtype="int64")
+    return minute
+
+def infer_timestep(minute, new_day):
+    # Most common step (h) between consecutive rows of the same day, 1 when no day has two rows
+    step = np.diff(minute)[~new_day[1:]]
+    step = step[step > 0]
+    if len(step) == 0:
+        return 1.0
+    return np.bincount(step).argmax()/60
+
+def weather_arrays(weather):
+    # Returns the hourly Hour, Temp and Isun columns as numpy arrays (missing values -> NaN)
+    hour = weather["Hour"].to_numpy()
+    temp = weather["Temp"].to_numpy(dtype="float64", na_value=np.nan)
+    Isun = weather["Isun"].to_numpy(dtype="float64", na_value=np.nan)
+    return hour, temp, Isun
+
+def AL_mask(hour, temp, Isun, shade, start, duration, rad_setpoint, tempsetpoint):
+    # Returns a boolean array which is True for every hour the AL are allowed to turn on (maximum)
+    #     1) hour is inside the AL window [start, start+duration+1)
+    #     2) radiation inside the GH is below the radiation setpoint
+    #     3) it is not a warm sunny hour (outside temp above the GH setpoint while the sun is up)
+    #   Comparisons against a missing (NaN) "Isun" or "Temp" are False, as in a plain Python comparison
+    #   Parameters may be arrays, they broadcast against the hourly arrays (e.g. hours x scenarios)
+
+    Isun3 = 0.8*(1-shade)*Isun
+
+    in_window = (hour >= start) & (hour < (start+duration+1))
+    below_setpoint = Isun3 < rad_setpoint
+    too_warm = (temp > tempsetpoint) & (Isun3 != 0)
+
+    return in_window & below_setpoint & ~too_warm
+
+# Light type codes used by the Hybrid dispatch (index into LIGHT_NAMES)
+NO_LIGHT, LED_LIGHT, HPS_LIGHT = 0, 1, 2
+LIGHT_NAMES = np.array(["None", "LED", "HPS"], dtype=object)
+
+def light_lookup(LED_value, HPS_value, none_value=np.nan):
+    # Small lookup array indexed by the light type code ("None" -> NaN)
+    return np.array([np.full_like(LED_value, none_value, dtype="float64"), LED_value, HPS_value], dtype="float64")
+
+def daily_running_count(on, index):
+    # For each row, how many rows were already ON earlier on the same day (segmented running count)
+    on = on.astype("int64")
+    total = np.cumsum(on, axis=0) - on              # hours ON before this row, across all days
+    return total - index.hourly(total[index.day_starts])
+
+def Hybrid_dispatch(index, AL_on, actual_hours, shade, day_tempsetpoint, night_tempsetpoint, AL_Intensity, LED_Intensity, HPS_Intensity):
+    # Returns the light type codes (Light1, Light2) for every row (chronological order)
+    #   actual_hours is the daily "Actual AL Hours" repeated for each row of the day
+
+    temp = index.temp.reshape(-1, *[1]*(np.ndim(AL_on)-1))
+    Isun3 = 0.8*(1-shade)*index.Isun.reshape(-1, *[1]*(np.ndim(AL_on)-1))
+
+    #   temperature setpoint specific to night (Isun3 == 0) or day time
+    cold = np.where(Isun3 == 0, temp < night_tempsetpoint, temp < day_tempsetpoint)
+
+    #   DECISION 1: Light1 is ON while AL are allowed and the daily hours (rounded to whole rows) are not used up yet
+    AL_on = AL_on.astype(bool)
+    light1_on = AL_on & (daily_running_count(AL_on, index) < np.round(actual_hours/index.timestep))
+    light1 = np.where(light1_on, np.where(cold, HPS_LIGHT, LED_LIGHT), NO_LIGHT).astype("int8")
+
+    #   DECISION 2: Light2 makes up for a first set of lights that does not reach the AL Intensity
+    light2 = np.where((light1 == HPS_LIGHT) & (HPS_Intensity < AL_Intensity), LED_LIGHT,
+             np.where((light1 == LED_LIGHT) & (LED_Intensity < AL_Intensity) & cold, HPS_LIGHT, NO_LIGHT)).astype("int8")
+
+    return light1, light2
+
+def max_AL_hours(index, shade, start, duration, rad_setpoint, tempsetpoint):
+    # Step 2 stage: rows the AL are allowed ON and their daily hours ("Max AL Hours")
+    AL_on = AL_mask(index.hour, index.temp, index.Isun, shade, start, duration, rad_setpoint, tempsetpoint)
+    return AL_on, index.timestep*index.daily_sum(AL_on.astype("int64"))
+
+def light_hours(index, AL_on, actual_hours, shade, day_tempsetpoint, night_tempsetpoint, AL_Intensity, LED_Intensity, HPS_Intensity):
+    # DECISION 1/2 stage: light type codes of every row and the hours each type is ON per day (Light1 + Light2)
+    light1, light2 = Hybrid_dispatch(
+        index, AL_on, index.hourly(actual_hours),
+        shade, day_tempsetpoint, night_tempsetpoint, AL_Intensity, LED_Intensity, HPS_Intensity
+    )
+    LED_hours = index.timestep*index.daily_sum((light1 == LED_LIGHT).astype("int64") + (light2 == LED_LIGHT))
+    HPS_hours = index.timestep*index.daily_sum((light1 == HPS_LIGHT).astype("int64") + (light2 == HPS_LIGHT))
+    return light1, light2, LED_hours, HPS_hours
+
+def monthly_table(index, natural, DLI_AL, month_elec, weights=None):
+    # Step 6: average monthly values from the daily DLI (days weighted by weights) and the monthly electricity
+    return {
+        "DLI Solar": index.month_mean(natural, weights),
+        "DLI AL": index.month_mean(DLI_AL, weights),
+        "DLI Total Stdev": index.month_std(natural + DLI_AL, weights),
+        "Elec Cons (kWh/m2)": month_elec
+    }
+
+def hourly_schedule(weather, index, columns, compact=False):
+    # Hourly table (row order of weather) with the time columns and the given chronological arrays
+    #   sub-hourly weather keeps its "Minute" column
+    #   compact: float values as float32 (half the memory, ~7 significant digits)
+    time_columns = ["Year", "Month", "Day", "Hour"] + (["Minute"] if index.timestep < 1 and "Minute" in weather else [])
+    schedule = weather[time_columns].copy()
+    for name, values in columns.items():
+        if compact and values.dtype.kind == "f":
+            values = values.astype("float32")
+        schedule[name] = index.rows(values)
+    return schedule
+
+@stops_profile
+def LED_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, GH_tempsetpoint=22, DLI_target=30, AL_Intensity = 200, LED_eff = 3.2, index=None, hourly=False, profile=None, cache=None):
     # Units of standard variable entries
     #     shade (fraction)
     #     start, duration (hour)
@@ -13,7 +506,19 @@ def LED_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, GH_te
     #     DLI_target (mol/m2/day)
     #     AL_Intensity (umol/m2/s) -> Real for selected LED fixture
     #     LED_eff (umol/J)
-       
+    #   index: WeatherIndex of weather (built here if not given, the timestep is then taken from the data)
+    #   hourly: also return the hourly schedule -> (monthly, schedule), "compact" -> float32 values
+    #   profile: StageProfile that records time and memory of each stage
+    #   cache: StageCache, stages are only recomputed when the inputs they depend on change
+    #   weather is only read, all intermediate values are kept in arrays
+
+    profile = NO_PROFILE if profile is None else profile
+    profile.start()
+
+    if index is None:
+        index = memo(cache, cache and ("index", weather_fingerprint(weather)), lambda: WeatherIndex(weather))
+        profile.lap("Index: day/month layout", len(weather))
+
     # ------------
     # --- Step 1: Calculate PAR at the canopy level (mol/m2/h)
     # ------------
@@ -24,58 +529,47 @@ def LED_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, GH_te
     #      conversion 1W = 4.6 umol
     k = 0.8*(1-shade)*0.5*4.6*3600/1000000
 
-    #      write in the calculated PAR at the canopy level into each row in the new column named 'PAR_Canopy' [mol/m2/h]
-    weather["PAR_Canopy"] = k*weather["Isun"].fillna(0) # mol/m2/h
+    #   sum the PAR at the canopy level per day to obtain the natural DLI (mol/m2/d)
+    natural = k*index.day_Isun
+    profile.lap("Step 1: PAR at the canopy", index.n_rows)
 
     # ------------
     # --- Step 2: Determine which hours AL will be ON (maximum)
     # ------------
 
-    weather["AL On/Off"]=0
-    for index, row in weather.iterrows():
-
-        hour = row["Hour"]
-        temp = row["Temp"]
-        Isun3 = 0.8*(1-shade)*row["Isun"]
-
-        if (hour >= start and hour < (start+duration+1)) and Isun3 < rad_setpoint and not (temp > GH_tempsetpoint and Isun3 != 0):
-            weather.at[index, "AL On/Off"] = 1
-        else:
-            weather.at[index, "AL On/Off"] = 0
-
-    #   Summarizes the weather data into daily rows including a column which sums the PAR values to obtain the natural DLI
-    daily = (
-        weather
-        .groupby(["Year", "Month", "Day"], as_index=False)
-        .agg(
-            **{
-            "Natural DLI": ("PAR_Canopy", "sum"),
-            "Max AL Hours": ("AL On/Off", "sum")
-            }
-        )
-    )
+    #   with a cache and no hourly schedule only the daily hours are needed: they are looked up in the SolarSummary of
+    #   the AL window, so a new shade or rad_setpoint does not go over the hourly rows again
+    if cache is not None and not hourly and shade <= 1:
+        summary = cache.get(("solar summary", index.fingerprint, start, duration, GH_tempsetpoint),
+                            lambda: SolarSummary(index, start, duration, GH_tempsetpoint))
+        max_hours = summary.max_hours(shade, rad_setpoint)
+    else:
+        AL_on, max_hours = memo(cache, cache and ("AL hours", index.fingerprint, shade, start, duration, rad_setpoint, GH_tempsetpoint),
+                                lambda: max_AL_hours(index, shade, start, duration, rad_setpoint, GH_tempsetpoint))
+    profile.lap("Step 2: AL hours (maximum)", index.n_rows)
 
     # ------------
     # --- Step 3: Determine which hours AL will be ON (actual)
     # ------------
 
     #   Calculate PAR needed (DLI_target - Natural DLI)
-    daily["PAR Needed"] = (DLI_target - daily["Natural DLI"]).clip(lower=0) # mol/m2/d
+    PAR_needed = np.clip(DLI_target - natural, 0, None) # mol/m2/d
 
     #   Calculate Actual AL Hours
-    hours_needed = daily["PAR Needed"] *1000000 / AL_Intensity / 3600
-    daily["Actual AL Hours"] = hours_needed.clip(lower=0, upper=daily["Max AL Hours"]) # h
+    hours_needed = PAR_needed *1000000 / AL_Intensity / 3600
+    actual_hours = np.clip(hours_needed, 0, max_hours) # h
 
     #   Calculate DLI contribution from AL
-    daily["DLI AL"] = AL_Intensity*3600/1000000*daily["Actual AL Hours"] # mol/m2/d
-    daily["DLI Total"] = daily["Natural DLI"] + daily["DLI AL"]
+    DLI_AL = AL_Intensity*3600/1000000*actual_hours # mol/m2/d
+    profile.lap("Step 3: AL hours (actual)", len(index.day_starts))
 
     # ------------
     # --- Step 4: Calculate electricity consumption per day
     # ------------
 
     #   Divide the remaining PAR needed by the AL Intensity. Then convert from J to kWh
-    daily["Elec Cons (kWh/m2)"] = AL_Intensity/LED_eff/1000*daily["Actual AL Hours"]
+    elec = AL_Intensity/LED_eff/1000*actual_hours
+    profile.lap("Step 4: Electricity", len(index.day_starts))
 
     # ------------
     # --- Step 5: Calculate heat generated per day
@@ -85,21 +579,24 @@ def LED_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, GH_te
     # --- Step 6: Summarize to a monthly table
     # ------------
 
-    monthly = (
-        daily.groupby(["Month"], as_index=False)
-        .agg(
-            **{
-            "DLI Solar": ("Natural DLI", "mean"),
-            "DLI AL": ("DLI AL", "mean"),
-            "DLI Total Stdev": ("DLI Total", "std"),
-            "Elec Cons (kWh/m2)": ("Elec Cons (kWh/m2)", "sum")
-            }
-        )
-    )
+    monthly = pd.DataFrame({
+        "Month": index.months,
+        **monthly_table(index, natural, DLI_AL, index.month_sum(elec))
+    })
+
+    profile.lap("Step 6: Monthly table", len(index.day_starts))
+    profile.stop()
 
+    if hourly:
+        return monthly, hourly_schedule(weather, index, {
+            "PAR_Canopy": k*index.timestep*np.where(np.isnan(index.Isun), 0, index.Isun),
+            "AL On/Off": AL_on.astype("int8"),
+            "Actual AL Hours": index.hourly(actual_hours)
+        }, compact=hourly == "compact")
     return monthly
 
-def Hybrid_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, day_tempsetpoint=22, night_tempsetpoint = 16, DLI_target=30, AL_Intensity = 200, LED_Intensity = 100, LED_eff = 3.2, HPS_Intensity = 100, HPS_eff = 1.8):
+@stops_profile
+def Hybrid_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, day_tempsetpoint=22, night_tempsetpoint = 16, DLI_target=30, AL_Intensity = 200, LED_Intensity = 100, LED_eff = 3.2, HPS_Intensity = 100, HPS_eff = 1.8, index=None, hourly=False, profile=None, cache=None):
     # Units of standard variable entries
     #     shade (fraction)
     #     start, duration (hour)
@@ -108,7 +605,20 @@ def Hybrid_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, da
     #     DLI_target (mol/m2/day)
     #     AL_Intensity (umol/m2/s) -> Desired for crop
     #     LED_eff (umol/J)
-   
+    #   index: WeatherIndex of weather (built here if not given, the timestep is then taken from the data)
+    #   hourly: also return the hourly lighting schedule -> (monthly, schedule),
+    #           "compact" -> float32 values (Light1/Light2 are always categorical)
+    #   profile: StageProfile that records time and memory of each stage
+    #   cache: StageCache, stages are only recomputed when the inputs they depend on change
+    #   weather is only read, all intermediate values are kept in arrays
+
+    profile = NO_PROFILE if profile is None else profile
+    profile.start()
+
+    if index is None:
+        index = memo(cache, cache and ("index", weather_fingerprint(weather)), lambda: WeatherIndex(weather))
+        profile.lap("Index: day/month layout", len(weather))
+
     # ------------
     # --- Step 1: Calculate PAR at the canopy level (mol/m2/h)
     # ------------
@@ -119,43 +629,29 @@ def Hybrid_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, da
     #      conversion 1W = 4.6 umol
     k = 0.8*(1-shade)*0.5*4.6*3600/1000000
 
-    #     write in the calculated PAR at the canopy level into each row in the new column named 'PAR_Canopy' [mol/m2/h]
-    weather["PAR_Canopy"] = k*weather["Isun"].fillna(0) # mol/m2/h
-
-    #     aggregate PAR_Canopy into a daily value "Natural DLI"
-    weather["Natural DLI"] = (weather.groupby(["Year", "Month", "Day"])["PAR_Canopy"].transform("sum"))
+    #     aggregate PAR at the canopy level into a daily value "Natural DLI" (mol/m2/d)
+    natural = k*index.day_Isun
+    profile.lap("Step 1: PAR at the canopy", index.n_rows)
 
     # ------------
     # --- Step 2: Determine which hours AL will be ON (maximum)
     # ------------
 
-    weather["AL On/Off"]=0
-    for index, row in weather.iterrows():
-
-        hour = row["Hour"]
-        temp = row["Temp"]
-        Isun3 = 0.8*(1-shade)*row["Isun"]
-
-        if (hour >= start and hour < (start+duration+1)) and Isun3 < rad_setpoint and not (temp > day_tempsetpoint and Isun3 != 0):
-            weather.at[index, "AL On/Off"] = 1
-        else:
-            weather.at[index, "AL On/Off"] = 0
-
-    # Calculate daily sums
-    weather["Max AL Hours"] = (
-        weather.groupby(["Year", "Month", "Day"])["AL On/Off"].transform("sum")
-    )
+    AL_on, max_hours = memo(cache, cache and ("AL hours", index.fingerprint, shade, start, duration, rad_setpoint, day_tempsetpoint),
+                            lambda: max_AL_hours(index, shade, start, duration, rad_setpoint, day_tempsetpoint))
+    profile.lap("Step 2: AL hours (maximum)", index.n_rows)
 
     # ------------
     # --- Step 3: Determine actual daily AL hours needed to reach Target DLI
     # ------------
 
     #   Calculate PAR needed (DLI_target - Natural DLI)
-    weather["PAR Needed"] = (DLI_target - weather["Natural DLI"]) # mol/m2/d
+    PAR_needed = DLI_target - natural # mol/m2/d
 
     #   Calculate Actual AL Hours
-    hours_needed = weather["PAR Needed"] *1000000 / AL_Intensity / 3600
-    weather["Actual AL Hours"] = hours_needed.clip(lower=0, upper=weather["Max AL Hours"]) # h
+    hours_needed = PAR_needed *1000000 / AL_Intensity / 3600
+    actual_hours = np.clip(hours_needed, 0, max_hours) # h
+    profile.lap("Step 3: AL hours (actual)", len(index.day_starts))
 
     # ------------
     # --- DECISION 1: Which lights will turn on at which hours?
@@ -165,33 +661,6 @@ def Hybrid_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, da
     #        1) "AL On/Off" == 1
     #        2) Cumulative hours < "Actual AL Hours"
 
-    weather["Light1"] = "None"
-    current_key = None
-    used_hours = 0       # how many hours Light1 has been ON so far "today"
-    for index, row in weather.iterrows():
-
-        key = (row["Year"], row["Month"], row["Day"])
-        if key != current_key:
-            # new day -> reset the daily counter
-            current_key = key
-            used_hours = 0
-
-        AL_ok = int(row["AL On/Off"]) == 1          # shows true if AL are allowed to turn on
-        max = int(round(row["Actual AL Hours"]))    # max for this day (same each hour)
-
-        if AL_ok and used_hours < max:
-            temp = row["Temp"]
-            Isun3 = 0.8*(1-shade)*row["Isun"]
-    
-            if Isun3 == 0:                          # if it is night time, compare to night time temp setpoint
-                weather.at[index, "Light1"] = "HPS" if temp < night_tempsetpoint else "LED"
-            else:                                   # if it is day time, comapre to day time temp setpoint
-                weather.at[index, "Light1"] = "HPS" if temp < day_tempsetpoint else "LED"
-            
-            used_hours += 1
-        else:
-            weather.at[index, "Light1"] = "None"
-
     # ------------
     # --- DECISION 2: Are the other set of lights needed (hourly decision) to reach the desired AL Intensity
     # ------------
@@ -201,68 +670,29 @@ def Hybrid_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, da
     #        2) First lights do not reach the AL Intensity goal
     #        3) Outside temperature is lower than GH setpoint temperature (setpoint specific to day or night)
 
-    weather["Light2"] = "None"
-    for index, row in weather.iterrows():
-
-        Light1 = row["Light1"]
-        temp = row["Temp"]
-        Isun3 = 0.8*(1-shade)*row["Isun"]
-
-        if Light1 == "None":
-            weather.at[index, "Light2"] = "None"
-        elif Light1 == "HPS":
-            weather.at[index, "Light2"] = "LED" if HPS_Intensity < AL_Intensity else "None"
-        else:
-            if Isun3 == 0:
-                weather.at[index, "Light2"] = "HPS" if LED_Intensity < AL_Intensity and temp < night_tempsetpoint else "None"
-            else:
-                weather.at[index, "Light2"] = "HPS" if LED_Intensity < AL_Intensity and temp < day_tempsetpoint else "None"
+    light1, light2, LED_hours, HPS_hours = memo(
+        cache, cache and ("dispatch", index.fingerprint, shade, start, duration, rad_setpoint, day_tempsetpoint,
+                          night_tempsetpoint, DLI_target, AL_Intensity, LED_Intensity, HPS_Intensity),
+        lambda: light_hours(index, AL_on, actual_hours, shade, day_tempsetpoint, night_tempsetpoint,
+                            AL_Intensity, LED_Intensity, HPS_Intensity)
+    )
+    profile.lap("DECISION 1/2: Light1 and Light2", index.n_rows)
 
     # ------------
     # --- Step 4: Calculate PAR and Elec from each light
     # ------------
 
-    weather["Light1 PAR"] = 0
-    weather["Light2 PAR"] = 0
-
-    weather["Light1 Elec"] = 0
-    weather["Light2 Elec"] = 0
-
-    for index, row in weather.iterrows():
-
-        type1 = row["Light1"]
-        type2 = row["Light2"]
+    #     PAR (mol/m2/h) and Elec (kWh/m2) of each light type, per hour it is ON
+    LED_PAR, HPS_PAR = LED_Intensity*3600/1000000, HPS_Intensity*3600/1000000
+    LED_Elec, HPS_Elec = LED_Intensity/LED_eff/1000, HPS_Intensity/HPS_eff/1000
 
-        if type1 == "None":
-            weather.at[index, "Light1 Elec"] = None
-            weather.at[index, "Light1 PAR"] = None
-        elif type1 == "LED":
-            weather.at[index, "Light1 Elec"] = LED_Intensity/LED_eff/1000 # kWh/m2
-            weather.at[index, "Light1 PAR"] = LED_Intensity*3600/1000000 # mol/m2/h
-        elif type1 == "HPS":
-            weather.at[index, "Light1 Elec"] = HPS_Intensity/HPS_eff/1000 # kWh/m2
-            weather.at[index, "Light1 PAR"] = HPS_Intensity*3600/1000000 # mol/m2/h
+    #     Light1 + Light2 per day (hours ON of each type x contribution of that type)
+    AL_PAR_daily = LED_hours*LED_PAR + HPS_hours*HPS_PAR
+    daily_elec = LED_hours*LED_Elec + HPS_hours*HPS_Elec
 
-        if type2 == "None":
-            weather.at[index, "Light2 Elec"] = None
-            weather.at[index, "Light2 PAR"] = None
-        elif type2 == "LED":
-            weather.at[index, "Light2 Elec"] = LED_Intensity/LED_eff/1000
-            weather.at[index, "Light2 PAR"] = LED_Intensity*3600/1000000 # mol/m2/h
-        elif type2 == "HPS":
-            weather.at[index, "Light2 Elec"] = HPS_Intensity/HPS_eff/1000
-            weather.at[index, "Light2 PAR"] = HPS_Intensity*3600/1000000 # mol/m2/h
-
-    #     Light1 + Light2 (add columns which are the sum of contribution from both sets of lights)
-    weather["Hourly Elec"] = weather[["Light1 Elec", "Light2 Elec"]].sum(axis=1, skipna=True)
-    weather["AL_PAR_hourly"] = weather[["Light1 PAR", "Light2 PAR"]].sum(axis=1, skipna=True) # mol/m2/h
-
-    #     Aggregate by Month (total electrical for each month & average daily PAR)
-    weather["Monthly Elec (kWh/m2)"] = (weather.groupby(["Year", "Month"])["Hourly Elec"].transform("sum"))
-    weather["AL_PAR_daily"] = (weather.groupby(["Year", "Month", "Day"])["AL_PAR_hourly"].transform("sum"))
-    weather["Month AVG PAR (mol/m2/d)"] = (weather.groupby(["Year", "Month"])["AL_PAR_daily"].transform("mean"))
-
-    weather["DLI Total"] = weather["Natural DLI"] + weather["AL_PAR_daily"]
+    #     Aggregate by Month (total electrical for each month)
+    month_elec = index.year_month_sum(daily_elec)[index.day_ym]      # per day
+    profile.lap("Step 4: PAR and Elec from each light", len(index.day_starts))
 
     # ------------
     # --- Step 5: Calculate heat generated per day
@@ -271,23 +701,443 @@ def Hybrid_usage(weather, shade=0.33, start=5, duration=16, rad_setpoint=300, da
     # ------------
     # --- Step 6: Generate 10-year average monthly table
     # ------------
-    monthly = (
-        weather.groupby("Month", as_index=False)
-        .agg(
-            **{
-            "DLI Solar": ("Natural DLI", "mean"),
-            "DLI AL": ("AL_PAR_daily", "mean"),
-            "DLI Total Stdev": ("DLI Total", "std"),
-            "Elec Cons (kWh/m2)": ("Monthly Elec (kWh/m2)", "mean")
-            }
-        )
-    )  
 
+    #     averages over hourly rows -> each day is weighted by its number of rows
+    monthly = pd.DataFrame({
+        "Month": index.months,
+        **monthly_table(index, natural, AL_PAR_daily,
+                        index.month_mean(month_elec, index.day_rows), index.day_rows)
+    })
+
+    profile.lap("Step 6: Monthly table", len(index.day_starts))
+    profile.stop()
+
+    if hourly:
+        #     PAR (mol/m2) and Elec (kWh/m2) of each row
+        dtype = "float32" if hourly == "compact" else "float64"
+        PAR = light_lookup(LED_PAR*index.timestep, HPS_PAR*index.timestep).astype(dtype)
+        Elec = light_lookup(LED_Elec*index.timestep, HPS_Elec*index.timestep).astype(dtype)
+        schedule = hourly_schedule(weather, index, {
+            "AL On/Off": AL_on.astype("int8"),
+            "Light1": light1,
+            "Light2": light2,
+            "Light1 PAR": PAR[light1],
+            "Light2 PAR": PAR[light2],
+            "Light1 Elec": Elec[light1],
+            "Light2 Elec": Elec[light2]
+        })
+        for light in ("Light1", "Light2"):
+            schedule[light] = pd.Categorical.from_codes(schedule[light], LIGHT_NAMES)
+        return monthly, schedule
+    return monthly
+
+# -------- Scenario sweep -------- #
+
+def scenario_grid(**params):
+    # Returns every combination of the given parameter values as a table with one row per scenario
+    #   e.g. scenario_grid(shade=[0.2, 0.3], start=[4, 5, 6]) -> 6 scenarios
+    grid = pd.MultiIndex.from_product([np.atleast_1d(values) for values in params.values()], names=list(params))
+    return grid.to_frame(index=False)
+
+def model_defaults(system):
+    # Parameters of LED_usage / Hybrid_usage and their default values (without the weather and the run options)
+    if system not in ("LED", "Hybrid"):
+        raise ValueError(f"Unknown system: '{system}' (use LED or Hybrid)")
+    model = LED_usage if system == "LED" else Hybrid_usage
+    return {name: p.default for name, p in inspect.signature(model).parameters.items() if name not in ("weather", "index", "hourly", "profile", "cache")}
+
+def scenario_params(scenarios, system, fixed):
+    # Parameter arrays (one value per scenario) of a sweep: the swept columns, then fixed, then the model defaults
+    defaults = model_defaults(system)
+
+    scenarios = pd.DataFrame(scenarios).reset_index(drop=True)
+    unknown = [c for c in [*scenarios.columns, *fixed] if c not in defaults]
+    if unknown:
+        raise KeyError(f"Unknown {system} parameters: {unknown}")
+    defaults.update(fixed)
+    params = {name: (scenarios[name].to_numpy(dtype="float64") if name in scenarios else np.full(len(scenarios), float(value)))
+              for name, value in defaults.items()}
+    return scenarios, params
+
+def mask_combos(params, system):
+    # AL eligibility only depends on a few parameters -> distinct combinations and the combination of each scenario
+    temp_setpoint = "GH_tempsetpoint" if system == "LED" else "day_tempsetpoint"
+    mask_keys = ["shade", "start", "duration", "rad_setpoint", temp_setpoint]
+    combos = pd.DataFrame({key: params[key] for key in mask_keys})
+    combo_id = combos.groupby(mask_keys, sort=False).ngroup().to_numpy()
+    return combos.drop_duplicates().to_numpy(), combo_id
+
+# Fewest combos of one AL window worth a SolarSummary in a sweep (below that the hourly mask is faster)
+SUMMARY_COMBOS = 8
+
+def sweep_days(block, params, system, combos, combo_id, chunk_size=64):
+    # Hourly stages of a sweep for one DayBlock -> daily natural DLI, AL DLI (mol/m2/d) and electricity (kWh/m2)
+    #   arrays are days x scenarios, the hourly work is done chunk_size scenarios at a time
+    hour, temp, Isun = block.hour[:, None], block.temp[:, None], block.Isun[:, None]
+    n_days, n_scenarios = len(block.day_starts), len(combo_id)
+
+    #   combos that share an AL window and temperature setpoint (at least SUMMARY_COMBOS of them) look their hours up
+    #   in one SolarSummary of the block, the others go through the hourly mask
+    max_hours = np.empty((n_days, len(combos)))
+    by_mask = np.ones(len(combos), dtype=bool)
+    windows, window_id = np.unique(combos[:, [1, 2, 4]], axis=0, return_inverse=True)
+    for w, (start, duration, tempsetpoint) in enumerate(windows):
+        columns = np.flatnonzero((window_id.ravel() == w) & (combos[:, 0] <= 1))
+        if len(columns) >= SUMMARY_COMBOS:
+            summary = SolarSummary(block, start, duration, tempsetpoint)
+            for c in range(0, len(columns), chunk_size):
+                shade, _, _, rad_setpoint, _ = combos[columns[c:c+chunk_size]].T
+                max_hours[:, columns[c:c+chunk_size]] = summary.max_hours(shade, rad_setpoint)
+            by_mask[columns] = False
+
+    by_mask = np.flatnonzero(by_mask)
+    for c in range(0, len(by_mask), chunk_size):
+        columns = by_mask[c:c+chunk_size]
+        max_hours[:, columns] = block.timestep*block.daily_sum(AL_mask(hour, temp, Isun, *combos[columns].T))
+
+    daily = {name: np.empty((n_days, n_scenarios)) for name in ("natural", "DLI_AL", "elec")}
+    for c in range(0, n_scenarios, chunk_size):
+        s = slice(c, c+chunk_size)
+        p = {name: values[None, s] for name, values in params.items()}
+
+        # --- Step 1: Natural DLI per day (mol/m2/d)
+        k = 0.8*(1-p["shade"])*0.5*4.6*3600/1000000
+        natural = k*block.day_Isun[:, None]
+
+        # --- Step 2/3: Maximum and actual AL hours per day
+        max_AL = max_hours[:, combo_id[s]]
+        hours_needed = (p["DLI_target"] - natural).clip(min=0)*1000000/p["AL_Intensity"]/3600
+        actual = np.clip(hours_needed, 0, max_AL)
+
+        if system == "LED":
+            # --- Step 4: DLI and electricity of the AL
+            DLI_AL = p["AL_Intensity"]*3600/1000000*actual
+            elec = p["AL_Intensity"]/p["LED_eff"]/1000*actual
+        else:
+            # --- DECISION 1/2: dispatch of both sets of lights, then hours ON of each type x its PAR/Elec
+            AL_on = AL_mask(hour, temp, Isun, p["shade"], p["start"], p["duration"], p["rad_setpoint"], p["day_tempsetpoint"])
+            LED_hours, HPS_hours = light_hours(
+                block, AL_on, actual,
+                p["shade"], p["day_tempsetpoint"], p["night_tempsetpoint"], p["AL_Intensity"], p["LED_Intensity"], p["HPS_Intensity"]
+            )[2:]
+            DLI_AL = LED_hours*p["LED_Intensity"]*3600/1000000 + HPS_hours*p["HPS_Intensity"]*3600/1000000
+            elec = LED_hours*p["LED_Intensity"]/p["LED_eff"]/1000 + HPS_hours*p["HPS_Intensity"]/p["HPS_eff"]/1000
+
+        daily["natural"][:, s], daily["DLI_AL"][:, s], daily["elec"][:, s] = natural, DLI_AL, elec
+
+    return daily
+
+def sweep_table(layout, daily, day_rows, system, scenarios):
+    # Step 6 of a sweep: tidy monthly table from the daily arrays of every scenario
+    #   layout: MonthLayout of the days, day_rows: rows per day (Hybrid averages weight each day by its rows)
+    if system == "LED":
+        month = monthly_table(layout, daily["natural"], daily["DLI_AL"], layout.month_sum(daily["elec"]))
+    else:
+        month_elec = layout.year_month_sum(daily["elec"])[layout.day_ym]
+        month = monthly_table(layout, daily["natural"], daily["DLI_AL"], layout.month_mean(month_elec, day_rows), day_rows)
+
+    monthly = pd.DataFrame({name: values.T.ravel() for name, values in month.items()})
+    monthly.insert(0, "Month", np.tile(layout.months, len(scenarios)))
+    monthly.insert(0, "Scenario", np.repeat(np.arange(len(scenarios)), len(layout.months)))
+    return monthly.merge(scenarios, left_on="Scenario", right_index=True)[["Scenario", *scenarios.columns, *monthly.columns[1:]]]
+
+@stops_profile
+def sweep_usage(weather, scenarios, system="LED", chunk_size=64, index=None, block_rows=20000, profile=None, **fixed):
+    # Runs LED_usage or Hybrid_usage for many scenarios in one pass over the hourly data
+    #   scenarios: table (or dict of equal length arrays) with one column per swept parameter
+    #   fixed: parameters shared by all scenarios, the others keep the default of the model function
+    #   Returns a tidy monthly table with one block of months per "Scenario" (row number in scenarios)
+    #   Work that does not depend on the parameters (daily sums, day/month layout) is done only once
+    #   The rows are processed in blocks of whole days (at most block_rows rows): the hourly arrays of a block are
+    #   block_rows x chunk_size, whatever the length or timestep of the record
+    #   profile: StageProfile/ProgressProfile, one stage per block of days
+
+    profile = NO_PROFILE if profile is None else profile
+    profile.start()
+
+    scenarios, params = scenario_params(scenarios, system, fixed)
+    combos, combo_id = mask_combos(params, system)
+
+    if index is None:
+        index = WeatherIndex(weather)
+        profile.lap("Index: day/month layout", len(weather))
+
+    n_days = len(index.day_starts)
+    daily = {name: np.empty((n_days, len(scenarios))) for name in ("natural", "DLI_AL", "elec")}
+    for first, block in index.blocks(block_rows):
+        last = first + len(block.day_starts)
+        for name, values in sweep_days(block, params, system, combos, combo_id, chunk_size).items():
+            daily[name][first:last] = values
+        profile.lap(f"Days {first + 1}-{last} of {n_days}", block.n_rows)
+
+    monthly = sweep_table(index, daily, index.day_rows, system, scenarios)
+    profile.lap("Step 6: Monthly table", n_days)
+    profile.stop()
     return monthly
 
+def stream_usage(chunks, scenarios=None, system="LED", timestep=None, chunk_size=64, **fixed):
+    # Runs the models on a weather record that is never held in memory as a whole
+    #   chunks: cleaned weather tables in chronological order (e.g. weather_io.iter_climatedata), a day may be split
+    #   over two chunks; each chunk is processed as soon as its days are complete and only daily values are kept
+    #   scenarios: as for sweep_usage (None -> one run with the fixed parameters, same table as LED_usage/Hybrid_usage)
+    #   timestep: hours per row (taken from the first chunk when not given)
+    single = scenarios is None
+    scenarios, params = scenario_params(pd.DataFrame(index=[0]) if single else scenarios, system, fixed)
+    combos, combo_id = mask_combos(params, system)
+
+    days, rows, daily, month_dtype = [], [], [], "int8"
+    carry = None
+
+    def process(weather):
+        nonlocal timestep, month_dtype
+        index = WeatherIndex(weather, timestep)
+        if days and index.day_stamp[0] <= days[-1][-1]:
+            raise ValueError("Weather chunks must be in chronological order (each day in one contiguous block).")
+        timestep, month_dtype = index.timestep, weather["Month"].dtype
+        days.append(index.day_stamp)
+        rows.append(index.day_rows)
+        daily.append(sweep_days(index, params, system, combos, combo_id, chunk_size))
+
+    for chunk in chunks:
+        weather = chunk if carry is None else pd.concat([carry, chunk], ignore_index=True)
+        if weather.empty:
+            continue
+        #   the last day may continue in the next chunk
+        last = ((weather["Year"] == weather["Year"].iloc[-1]) & (weather["Month"] == weather["Month"].iloc[-1])
+                & (weather["Day"] == weather["Day"].iloc[-1])).to_numpy()
+        complete = np.flatnonzero(~last)
+        complete = complete[-1] + 1 if len(complete) else 0
+        if complete:
+            process(weather.iloc[:complete])
+        carry = weather.iloc[complete:]
+    if carry is not None and not carry.empty:
+        process(carry)
+
+    if not days:
+        raise ValueError("No weather rows to process.")
+
+    layout = MonthLayout(np.concatenate(days), month_dtype)
+    daily = {name: np.concatenate([d[name] for d in daily]) for name in daily[0]}
+    monthly = sweep_table(layout, daily, np.concatenate(rows), system, scenarios)
+    return monthly.drop(columns="Scenario") if single else monthly
+
+# -------- Setpoint optimizer -------- #
+
+#   Candidate values searched by optimize_setpoints
+SEARCH_SPACE = {
+    "start": np.arange(0, 24),
+    "duration": np.arange(1, 25),
+    "rad_setpoint": np.arange(0, 1001, 25),
+    "LED_Intensity": np.arange(0, 401, 25),     # Hybrid only
+    "HPS_Intensity": np.arange(0, 401, 25),     # Hybrid only
+}
+
+def scenario_objectives(monthly, index, system, DLI_target, tolerance):
+    # Annual electricity and DLI shortfall of every scenario in a sweep_usage table
+    #   LED "Elec Cons" is summed over all years of a month -> divided by the number of years
+    #   Hybrid "Elec Cons" is already the average month
+    months = monthly["Month"].to_numpy()
+    years = index.month_years[np.searchsorted(index.months, months)] if system == "LED" else 1
+    deficit = DLI_target - (monthly["DLI Solar"] + monthly["DLI AL"])
+
+    per_scenario = pd.DataFrame({
+        "Scenario": monthly["Scenario"],
+        "elec": monthly["Elec Cons (kWh/m2)"] / years,
+        "shortfall": deficit.clip(lower=0),
+        "deficit": deficit
+    }).groupby("Scenario")
+    worst = per_scenario["deficit"].max()
+    return pd.DataFrame({
+        "Elec Cons (kWh/m2/yr)": per_scenario["elec"].sum(),
+        "DLI Shortfall (mol/m2/d)": per_scenario["shortfall"].mean(),
+        "Worst Deficit (mol/m2/d)": worst,
+        "Feasible": worst <= tolerance
+    })
+
+def pareto_front(table, x="Elec Cons (kWh/m2/yr)", y="DLI Shortfall (mol/m2/d)"):
+    # Rows that no other row beats on both x and y (both minimized), sorted by x
+    table = table.sort_values([x, y], kind="stable")
+    best_y = np.minimum.accumulate(table[y].to_numpy())
+    keep = np.ones(len(table), dtype=bool)
+    keep[1:] = table[y].to_numpy()[1:] < best_y[:-1]
+    return table[keep]
+
+@stops_profile
+def optimize_setpoints(weather, system="LED", DLI_target=30, tolerance=1.0, params=None, coarse_points=3, survivors=8, index=None, profile=None, **fixed):
+    # Searches start, duration, rad_setpoint (and for Hybrid the LED/HPS intensities) for the lowest annual electricity
+    # while every monthly "DLI Total" stays within tolerance (mol/m2/d) of DLI_target
+    #   params: names of the searched parameters and their candidate values (default SEARCH_SPACE)
+    #   fixed: other model parameters (shade, efficacies, ...)
+    #   Returns the Pareto front of annual electricity vs. average monthly DLI shortfall, "Best" marks the
+    #   lowest-electricity feasible setting (added to the table when the front does not hold it)
+    #
+    #   1) a coarse grid (coarse_points values per parameter) is evaluated in one sweep_usage call
+    #   2) kept for the next round: at most survivors points spread along the Pareto front, the survivors cheapest
+    #      feasible settings and the survivors cheaper settings that miss the tolerance by the least
+    #      (feasibility is not one of the front objectives -> the best setting need not be on the front)
+    #   3) the step between candidate values is halved and every kept setting is moved one step along one or two
+    #      parameters (e.g. start back and duration up: same end of the window), the cheapest feasible setting
+    #      also to every value of each parameter (crosses plateaus of equal electricity, e.g. rad_setpoint values
+    #      above the sunlight of the AL window); all moves are again evaluated in one batch
+    #   4) repeats until the step is one candidate value and a round finds no cheaper feasible setting
+    #   profile: StageProfile/ProgressProfile, one stage per evaluated batch
+
+    profile = NO_PROFILE if profile is None else profile
+    profile.start()
+
+    if params is None:
+        names = ["start", "duration", "rad_setpoint"] + (["LED_Intensity", "HPS_Intensity"] if system == "Hybrid" else [])
+        params = {name: SEARCH_SPACE[name] for name in names}
+    values = {name: np.sort(np.atleast_1d(v)) for name, v in params.items()}
+
+    if index is None:
+        index = WeatherIndex(weather)
+
+    evaluated = {}       # candidate (tuple of value positions) -> objectives
+
+    def evaluate(candidates):
+        candidates = [c for c in dict.fromkeys(candidates) if c not in evaluated]
+        if not candidates:
+            return
+        grid = pd.DataFrame([[values[name][i] for name, i in zip(values, c)] for c in candidates], columns=list(values))
+        monthly = sweep_usage(weather, grid, system=system, index=index, profile=NestedProfile(profile), DLI_target=DLI_target, **fixed)
+        objectives = scenario_objectives(monthly, index, system, DLI_target, tolerance)
+        for c, row in zip(candidates, objectives.to_dict("records")):
+            evaluated[c] = row
+
+    def table():
+        return pd.DataFrame(list(evaluated.values()), index=pd.MultiIndex.from_tuples(list(evaluated)))
+
+    def cheapest_feasible(table):
+        # Feasible settings from the cheapest, equal electricity -> lowest values first (lower is never more costly)
+        feasible = table[table["Feasible"]].sort_index()
+        return feasible.sort_values("Elec Cons (kWh/m2/yr)", kind="stable")
+
+    def kept(table, cheapest):
+        # Settings carried into the next round
+        current = pareto_front(table)
+        spread = current.index[np.unique(np.linspace(0, len(current) - 1, min(survivors, len(current))).round().astype(int))]
+        bound = cheapest["Elec Cons (kWh/m2/yr)"].iloc[0] if len(cheapest) else np.inf
+        closest = table[table["Elec Cons (kWh/m2/yr)"] < bound].sort_values("Worst Deficit (mol/m2/d)", kind="stable")
+        return list(dict.fromkeys([*spread, *cheapest.index[:survivors], *closest.index[:survivors]]))
+
+    # --- Coarse grid
+    step = {name: max(1, (len(v) - 1) // max(coarse_points - 1, 1)) for name, v in values.items()}
+    axes = [sorted(set(range(0, len(v), step[name])) | {len(v) - 1}) for name, v in values.items()]
+    evaluate(list(itertools.product(*axes)))
+    profile.lap(f"Coarse grid ({len(evaluated)} settings)", index.n_rows)
+
+    # --- Refine around the front
+    directions = [d for d in itertools.product((-1, 0, 1), repeat=len(values)) if 0 < np.abs(d).sum() <= 2]
+    cheapest_before = None
+    while True:
+        current = table()
+        cheapest = cheapest_feasible(current)
+        if all(s == 1 for s in step.values()) and list(cheapest.index[:survivors]) == cheapest_before:
+            break
+        cheapest_before = list(cheapest.index[:survivors])
+
+        moves = []
+        for c in kept(current, cheapest):
+            for d in directions:
+                moves.append(tuple(min(max(i + move*step[name], 0), len(values[name]) - 1)
+                                   for i, move, name in zip(c, d, values)))
+        for c in cheapest.index[:1]:
+            for p, name in enumerate(values):
+                moves.extend(c[:p] + (i,) + c[p+1:] for i in range(len(values[name])))
+        evaluate(moves)
+        profile.lap(f"Refine around the front ({len(evaluated)} settings)", index.n_rows)
+        step = {name: max(1, s // 2) for name, s in step.items()}
+
+    current = table()
+    result = pareto_front(current)
+    best = cheapest_feasible(current).iloc[:1]
+    if not best.empty and best.index[0] not in result.index:
+        result = pd.concat([result, best]).sort_values(["Elec Cons (kWh/m2/yr)", "DLI Shortfall (mol/m2/d)"], kind="stable")
+    keys = list(result.index)
+    for p, name in enumerate(values):
+        result.insert(p, name, [values[name][c[p]] for c in keys])
+    result = result.reset_index(drop=True)
+    result["Best"] = [not best.empty and key == best.index[0] for key in keys]
+
+    profile.stop()
+    return result
+
+# -------- Year resampling -------- #
+
+def year_month_blocks(index, daily, system):
+    # Sums of the daily results per (Year, Month) block, from which the monthly table of any set of years follows
+    #   weight: days (LED) or rows (Hybrid) of each block, the averages of the monthly table are weighted the same way
+    #   elec: LED -> electricity of the block (the table sums it over the years)
+    #         Hybrid -> electricity of the block x its weight (the table averages the monthly totals over the rows)
+    day_weights = np.ones(len(index.day_starts)) if system == "LED" else index.day_rows.astype("float64")
+    weight = index.year_month_sum(day_weights)
+    elec = index.year_month_sum(daily["elec"])
+    return {
+        "weight": weight,
+        "natural": index.year_month_sum(day_weights[:, None]*daily["natural"])[:, 0],
+        "DLI_AL": index.year_month_sum(day_weights[:, None]*daily["DLI_AL"])[:, 0],
+        "elec": (elec if system == "LED" else elec*weight[:, None])[:, 0]
+    }
+
+def bootstrap_usage(weather, system="LED", draws=2000, percentiles=(5, 95), seed=0, index=None, **params):
+    # Monthly table of LED_usage / Hybrid_usage with percentile bands from resampling the years of the record
+    #   every draw picks, for each calendar month, as many years as the record covers (with replacement) and
+    #   recomputes the table values from those years -> bands of the multi-year "DLI Total", "DLI Shortfall"
+    #   (below DLI_target) and "Elec Cons"; a month covered by one year only has no spread
+    #   The model runs once, per day; the draws only add up the per (Year, Month) sums
+    #   params: model parameters (the others keep the default of the model function)
+
+    if index is None:
+        index = WeatherIndex(weather)
+
+    scenarios, values = scenario_params(pd.DataFrame(index=[0]), system, params)
+    combos, combo_id = mask_combos(values, system)
+    daily = sweep_days(index, values, system, combos, combo_id)
+    monthly = sweep_table(index, daily, index.day_rows, system, scenarios).drop(columns="Scenario")
+
+    blocks = year_month_blocks(index, daily, system)
+    block_month = index.day_month[index.ym_starts]
+    DLI_target = values["DLI_target"][0]
+    rng = np.random.default_rng(seed)
+
+    bands = {name: np.empty((len(percentiles), len(index.months))) for name in ("DLI Total", "DLI Shortfall", "Elec Cons")}
+    for m in range(len(index.months)):
+        years = np.flatnonzero(block_month == m)
+        pick = years[rng.integers(0, len(years), size=(draws, len(years)))]      # draws x years
+
+        weight = blocks["weight"][pick].sum(axis=1)
+        total = (blocks["natural"][pick].sum(axis=1) + blocks["DLI_AL"][pick].sum(axis=1)) / weight
+        elec = blocks["elec"][pick].sum(axis=1)
+        if system == "Hybrid":
+            elec = elec / weight
+
+        bands["DLI Total"][:, m] = np.percentile(total, percentiles)
+        bands["DLI Shortfall"][:, m] = np.percentile(np.clip(DLI_target - total, 0, None), percentiles)
+        bands["Elec Cons"][:, m] = np.percentile(elec, percentiles)
+
+    monthly["DLI Total"] = monthly["DLI Solar"] + monthly["DLI AL"]
+    monthly["DLI Shortfall"] = np.clip(DLI_target - monthly["DLI Total"], 0, None)
+    for name, band in bands.items():
+        for p, column in zip(percentiles, band):
+            monthly[band_column(name, p)] = column
+    return monthly
+
+def band_column(name, percentile):
+    # e.g. "DLI Total p5", "Elec Cons p95 (kWh/m2)"
+    return f"{name} p{percentile:g}" + (" (kWh/m2)" if name == "Elec Cons" else "")
+
+def band_columns(monthly, name):
+    # (lowest, highest) percentile columns of name in a bootstrap_usage table, None when the table has no bands
+    prefix = f"{name} p"
+    found = sorted((float(c[len(prefix):].split()[0]), c) for c in monthly.columns if c.startswith(prefix))
+    if len(found) < 2:
+        return None
+    return found[0][1], found[-1][1]
+
 # -------- Plotting functions ------- #
 
-def plot_avgDLI(monthly, months, savepath="AverageDLI_hybrid.png"):
+def plot_avgDLI(monthly, months, savepath=None):
     
     fig, ax = plt.subplots()
 
@@ -310,7 +1160,7 @@ def plot_avgDLI(monthly, months, savepath="AverageDLI_hybrid.png"):
     
     return fig
 
-def barplot_avgDLI(monthly, months, savepath="AverageDLI.png"):
+def barplot_avgDLI(monthly, months, savepath=None):
     
     fig, ax = plt.subplots()
 
@@ -319,7 +1169,15 @@ def barplot_avgDLI(monthly, months, savepath="AverageDLI.png"):
     ax.bar(months, monthly["DLI AL"], bottom=monthly["DLI Solar"],
            label="DLI AL", color="coral", alpha=0.7)
     total = monthly["DLI Solar"] + monthly["DLI AL"]
-    ax.errorbar(range(len(months)), total, yerr=monthly["DLI Total Stdev"], fmt="none", capsize=5, color="black")
+    band = band_columns(monthly, "DLI Total")
+    if band is None:
+        ax.errorbar(range(len(months)), total, yerr=monthly["DLI Total Stdev"], fmt="none", capsize=5, color="black")
+    else:
+        # percentile band of the average from bootstrap_usage
+        low, high = band
+        yerr = [(total - monthly[low]).clip(lower=0), (monthly[high] - total).clip(lower=0)]
+        ax.errorbar(range(len(months)), total, yerr=yerr, fmt="none", capsize=5, color="black",
+                    label=f"{low.split()[-1]}-{high.split()[-1]}")
     
     ax.legend(loc="upper left")
     ax.set_xticks([])   # removes ticks and labels
@@ -336,4 +1194,32 @@ def barplot_avgDLI(monthly, months, savepath="AverageDLI.png"):
     if savepath:
         fig.savefig(savepath, dpi=300)
 
-    return fig
\ No newline at end of file
+    return fig
+
+# -------- Figure cache ------- #
+
+#   PNG bytes of the plots, keyed on (plot, months, dpi, content of the monthly table)
+FIGURE_CACHE_SIZE = 32
+_figure_cache = OrderedDict()
+_figure_lock = threading.Lock()     # pyplot keeps global state -> render one figure at a time
+
+def figure_png(plot, monthly, months, dpi=100):
+    # Returns the PNG bytes of plot (plot_avgDLI or barplot_avgDLI), rendered only once per monthly table and dpi
+    key = (plot.__name__, tuple(months), dpi, tuple(monthly.columns),
+           pd.util.hash_pandas_object(monthly, index=False).to_numpy().tobytes())
+
+    with _figure_lock:
+        if key in _figure_cache:
+            _figure_cache.move_to_end(key)
+            return _figure_cache[key]
+
+        fig = plot(monthly, months)
+        buf = io.BytesIO()  # creates a virtual container to hold binary data
+        fig.savefig(buf, format="png", dpi=dpi, bbox_inches="tight")
+        plt.close(fig)
+
+        _figure_cache[key] = buf.getvalue()
+        while len(_figure_cache) > FIGURE_CACHE_SIZE:
+            _figure_cache.popitem(last=False)
+        return _figure_cache[key]
+
@@ -0,0 +1,51 @@
+# PURPOSE #
+# Runs calculations outside the Streamlit script thread so the page stays responsive.
+#   A bounded pool of worker threads is shared by all sessions: at most max_workers calculations run at once and
+#   later ones wait in line, so one large upload does not slow every other user down.
+#   Each job gets a ProgressProfile: the page reads the last finished model stage from it and cancel() stops the
+#   run at its next stage (a job that is still waiting in line is dropped right away).
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+from growlights import ProgressProfile, Cancelled
+
+class Job:
+
+    def __init__(self, future, progress):
+        self.future = future
+        self.progress = progress
+        self.submitted = time.perf_counter()
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        self.progress.cancel()
+        self.future.cancel()
+
+    def result(self):
+        # Return value of the calculation, raises its error (Cancelled when the job was cancelled)
+        try:
+            return self.future.result()
+        except CancelledError:
+            raise Cancelled("The calculation was cancelled.") from None
+
+    def status(self):
+        # One line for the page, e.g. "Step 2: AL hours (maximum) done (1.3 s)"
+        seconds = time.perf_counter() - self.submitted
+        if self.progress.done == 0:
+            state = "Waiting for a free worker" if self.progress.stage == "Waiting" else "Started"
+        else:
+            state = f"{self.progress.stage} done"
+        return f"{state} ({seconds:.1f} s)"
+
+class JobPool:
+
+    def __init__(self, max_workers=2):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="growlights")
+
+    def submit(self, func, *args, profile=None, **kwargs):
+        # Runs func(*args, progress=ProgressProfile(profile), **kwargs) on a worker thread
+        #   profile: StageProfile that also records the diagnostics of the run
+        progress = ProgressProfile(profile)
+        return Job(self._pool.submit(func, *args, progress=progress, **kwargs), progress)
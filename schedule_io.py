@@ -0,0 +1,42 @@
+# PURPOSE #
+# Writes the hourly lighting schedule (LED_usage / Hybrid_usage with hourly=True or "compact") to Parquet or CSV
+#   block by block, so a schedule of many years is never turned into one large string
+#   Parquet keeps the column types (int8 codes, float32 values, Light1/Light2 as dictionary encoded categories) and
+#   gets one row group per block; CSV is written as text blocks of chunk_rows rows
+import os
+
+SCHEDULE_KINDS = {"parquet": "application/octet-stream", "csv": "text/csv"}
+
+def iter_blocks(schedule, chunk_rows):
+    for start in range(0, len(schedule), chunk_rows):
+        yield schedule.iloc[start:start + chunk_rows]
+
+def iter_schedule_csv(schedule, chunk_rows=100000):
+    # Yields the CSV file as UTF-8 bytes, one block of rows at a time (header with the first block)
+    if schedule.empty:
+        yield schedule.to_csv(index=False).encode("utf-8")
+        return
+    for i, block in enumerate(iter_blocks(schedule, chunk_rows)):
+        yield block.to_csv(index=False, header=i == 0).encode("utf-8")
+
+def write_schedule(schedule, target, kind="parquet", chunk_rows=100000):
+    # Writes the schedule to target (path or binary file object), kind: "parquet" or "csv"
+    if kind not in SCHEDULE_KINDS:
+        raise ValueError(f"Unsupported schedule format: '{kind}' (use parquet or csv)")
+
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, "wb") as f:
+            return write_schedule(schedule, f, kind, chunk_rows)
+
+    if kind == "csv":
+        for data in iter_schedule_csv(schedule, chunk_rows):
+            target.write(data)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(schedule.iloc[:0], preserve_index=False)
+    with pq.ParquetWriter(target, schema) as writer:
+        for block in iter_blocks(schedule, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(block, schema=schema, preserve_index=False))
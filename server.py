@@ -0,0 +1,314 @@
+# PURPOSE #
+# Local HTTP service around LED_usage / Hybrid_usage for other tools (standard library http.server, JSON in and out).
+#   1) the weather file is uploaded once and addressed by the hash of its bytes
+#        POST /weather?name=site.xlsx     body: the raw file (xlsx, csv or parquet)
+#          -> {"weather": "<hash>", "rows": 87600, "timestep": 1.0}
+#        GET  /weather/<hash>             -> same answer, 404 when the hash is not known
+#   2) monthly tables are requested with the hash and the model parameters
+#        POST /usage   body: {"weather": "<hash>", "system": "LED", "params": {"shade": 0.3}, "timestep": null}
+#          -> {"weather": ..., "system": ..., "params": {every parameter}, "cached": false, "monthly": [{"Month": 1, ...}]}
+#        POST /usage   body: {"requests": [{...}, {...}]}
+#          -> {"results": [...]} in the same order, a failed request gives {"error": ..., "status": ...} in its place
+#   3) the hourly lighting schedule of one request is streamed block by block (never held as one file in memory)
+#        POST /schedule   body: a usage request with "format": "csv" (default) or "parquet"
+#   Results are kept in an LRU cache keyed on (weather hash, system, timestep, every parameter as float), so two requests
+#   that only differ in how a parameter is written (5 vs 5.0, left out vs default) share one entry. The uncached requests
+#   of a batch that use the same weather and system are calculated together in one sweep_usage pass.
+#
+#   python server.py --port 8765
+import argparse
+import io
+import json
+import math
+import re
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from growlights import WeatherIndex, StageCache, LED_usage, Hybrid_usage, sweep_usage, model_defaults
+from schedule_io import iter_schedule_csv, write_schedule, SCHEDULE_KINDS
+from weather_cache import WeatherCache
+from weather_io import read_climatedata, file_kind
+
+WEATHER_KEY = re.compile(r"[0-9a-f]{64}")          # sha256 hash returned by /weather
+
+class APIError(Exception):
+    # Error returned to the client with an HTTP status
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+# ---------- Service ---------- #
+
+class GrowLightsAPI:
+    # The service without the HTTP layer (the handler only decodes and encodes JSON)
+
+    def __init__(self, cache_dir=".weather_cache", max_results=256, max_stages=64):
+        self.weather = WeatherCache(cache_dir)
+        self.results = StageCache(maxsize=max_results)
+        self.stages = StageCache(maxsize=max_stages)
+
+    def upload(self, data, name):
+        # Stores an uploaded weather file, returns its description (the file is only parsed the first time)
+        try:
+            kind = file_kind(name)
+        except ValueError as e:
+            raise APIError(str(e)) from None
+
+        key = WeatherCache.key(data)
+        try:
+            self.weather.load(data, lambda data: read_climatedata(io.BytesIO(data), kind=kind), key=key)
+        except (KeyError, ValueError) as e:
+            raise APIError(f"Could not read the weather file: {e}") from None
+        return self.describe(key)
+
+    def describe(self, key, timestep=None):
+        self.check_key(key)
+        index = self.index(key, timestep)
+        return {"weather": key, "rows": index.n_rows, "days": len(index.day_starts), "timestep": index.timestep}
+
+    def index(self, key, timestep=None):
+        weather = self.weather.get(key)
+        if weather is None:
+            raise APIError(f"Unknown weather '{key}', upload it to /weather first", status=404)
+        return self.stages.get(("index", key, timestep), lambda: WeatherIndex(weather, timestep))
+
+    @staticmethod
+    def check_key(key):
+        # The hash becomes a file name in the weather cache, anything else is refused
+        if not isinstance(key, str) or not WEATHER_KEY.fullmatch(key):
+            raise APIError("'weather' must be the hash returned by /weather")
+
+    def normalize(self, request):
+        # Checks one usage request -> (result cache key, system, timestep, full parameter dict)
+        if not isinstance(request, dict):
+            raise APIError("A usage request must be a JSON object")
+        unknown = [k for k in request if k not in ("weather", "system", "params", "timestep")]
+        if unknown:
+            raise APIError(f"Unknown request fields: {unknown}")
+        self.check_key(request.get("weather"))
+
+        system = request.get("system", "LED")
+        try:
+            params = model_defaults(system)
+        except ValueError as e:
+            raise APIError(str(e)) from None
+
+        given = request.get("params", {})
+        if not isinstance(given, dict):
+            raise APIError("'params' must be a JSON object")
+        unknown = [k for k in given if k not in params]
+        if unknown:
+            raise APIError(f"Unknown {system} parameters: {unknown}")
+        try:
+            params.update({k: float(v) for k, v in given.items()})
+            params = {k: float(v) for k, v in params.items()}
+            timestep = None if request.get("timestep") is None else float(request["timestep"])
+        except (TypeError, ValueError):
+            raise APIError("Parameters and timestep must be numbers") from None
+        if not all(map(math.isfinite, [*params.values(), *([] if timestep is None else [timestep])])):
+            raise APIError("Parameters and timestep must be finite numbers")
+
+        return (request["weather"], system, timestep, *params.values()), system, timestep, params
+
+    def usage(self, requests):
+        # Monthly tables of a list of usage requests (one answer per request, errors in place)
+        answers = [None]*len(requests)
+        groups = {}          # (weather, system, timestep) -> {result key: (params, [request positions])}
+
+        for i, request in enumerate(requests):
+            try:
+                key, system, timestep, params = self.normalize(request)
+            except APIError as e:
+                answers[i] = {"error": str(e), "status": e.status}
+                continue
+
+            monthly = self.results.lookup(key)
+            if monthly is not None:
+                answers[i] = self.answer(key, params, monthly, cached=True)
+            else:
+                group = groups.setdefault(key[:3], {})
+                group.setdefault(key, (params, []))[1].append(i)
+
+        for (weather, system, timestep), group in groups.items():
+            try:
+                tables = self.calculate(weather, system, timestep, [params for params, _ in group.values()])
+            except Exception as e:
+                #   a failing model run only fails the requests of its group, not the whole batch
+                error = (str(e), e.status) if isinstance(e, APIError) else (f"{type(e).__name__}: {e}", 500)
+                for _, positions in group.values():
+                    for i in positions:
+                        answers[i] = {"error": error[0], "status": error[1]}
+                continue
+
+            for (key, (params, positions)), monthly in zip(group.items(), tables):
+                self.results.store(key, monthly)
+                for i in positions:
+                    answers[i] = self.answer(key, params, monthly, cached=False)
+
+        return answers
+
+    def calculate(self, weather_key, system, timestep, scenarios):
+        # Monthly tables for a list of parameter dicts on one weather: one run, or one sweep for several
+        index = self.index(weather_key, timestep)
+        weather = self.weather.get(weather_key)
+
+        if len(scenarios) == 1:
+            usage = LED_usage if system == "LED" else Hybrid_usage
+            return [usage(weather, index=index, cache=self.stages, **scenarios[0])]
+
+        monthly = sweep_usage(weather, pd.DataFrame(scenarios), system=system, index=index)
+        columns = ["Month", *monthly.columns[monthly.columns.get_loc("Month") + 1:]]
+        return [table[columns].reset_index(drop=True) for _, table in monthly.groupby("Scenario", sort=True)]
+
+    def schedule(self, request):
+        # Hourly lighting schedule (compact columns) of one usage request, the model stages come from the stage cache
+        _, system, timestep, params = self.normalize(request)
+        usage = LED_usage if system == "LED" else Hybrid_usage
+        weather = self.weather.get(request["weather"])
+        index = self.index(request["weather"], timestep)
+        return usage(weather, index=index, cache=self.stages, hourly="compact", **params)[1]
+
+    @staticmethod
+    def answer(key, params, monthly, cached):
+        records = monthly.astype(object).where(monthly.notna(), None).to_dict(orient="records")
+        return {"weather": key[0], "system": key[1], "timestep": key[2], "params": params, "cached": cached, "monthly": records}
+
+# ---------- HTTP ---------- #
+
+class Handler(BaseHTTPRequestHandler):
+    # self.server.api is the GrowLightsAPI of the server
+    max_upload = 512*1024*1024          # bytes
+
+    def do_GET(self):
+        path = urlparse(self.path).path.strip("/").split("/")
+        if len(path) == 2 and path[0] == "weather":
+            self.respond(lambda: self.server.api.describe(path[1]))
+        elif path == ["health"]:
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"Unknown path '{self.path}'"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/weather":
+            name = parse_qs(url.query).get("name", [None])[0] or self.headers.get("X-Filename", "")
+            self.respond(lambda: self.server.api.upload(self.read_body(), name))
+        elif url.path == "/usage":
+            self.respond(self.usage)
+        elif url.path == "/schedule":
+            self.send_schedule()
+        else:
+            self.send_json(404, {"error": f"Unknown path '{self.path}'"})
+
+    def usage(self):
+        try:
+            body = json.loads(self.read_body())
+        except ValueError:
+            raise APIError("The body is not valid JSON") from None
+
+        if isinstance(body, dict) and "requests" in body:
+            if not isinstance(body["requests"], list):
+                raise APIError("'requests' must be a list")
+            return {"results": self.server.api.usage(body["requests"])}
+
+        answer = self.server.api.usage([body])[0]
+        if "error" in answer:
+            raise APIError(answer["error"], answer["status"])
+        return answer
+
+    def send_schedule(self):
+        # Streams the schedule: CSV text blocks or Parquet row groups are written to the socket as they are made
+        try:
+            try:
+                request = json.loads(self.read_body())
+            except ValueError:
+                raise APIError("The body is not valid JSON") from None
+            kind = request.pop("format", "csv") if isinstance(request, dict) else None
+            if kind not in SCHEDULE_KINDS:
+                raise APIError(f"Unsupported schedule format: '{kind}' (use csv or parquet)")
+            schedule = self.server.api.schedule(request)
+        except APIError as e:
+            return self.send_json(e.status, {"error": str(e)})
+        except Exception as e:
+            return self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        #   no Content-Length: the end of the body is the end of the connection
+        self.send_response(200)
+        self.send_header("Content-Type", SCHEDULE_KINDS[kind])
+        self.send_header("Content-Disposition", f'attachment; filename="Hourly_schedule.{kind}"')
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        if kind == "csv":
+            for data in iter_schedule_csv(schedule):
+                self.wfile.write(data)
+        else:
+            write_schedule(schedule, self.wfile, kind)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > self.max_upload:
+            raise APIError("The upload is too large", status=413)
+        return self.rfile.read(length)
+
+    def respond(self, compute):
+        try:
+            self.send_json(200, compute())
+        except APIError as e:
+            self.send_json(e.status, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=json_value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def json_value(value):
+    # numpy scalars in the tables -> plain JSON numbers (NaN -> null)
+    if isinstance(value, np.generic):
+        value = value.item()
+        return None if isinstance(value, float) and value != value else value
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def make_server(host="127.0.0.1", port=8765, api=None, verbose=False):
+    # HTTP server bound to host:port (port 0 -> a free port, see server.server_address), call serve_forever() to run it
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.api = GrowLightsAPI() if api is None else api
+    server.verbose = verbose
+    return server
+
+# ---------- Command line ---------- #
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the grow light calculations as a local JSON API")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: localhost only)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cache-dir", default=".weather_cache", help="folder of the uploaded weather (Parquet)")
+    parser.add_argument("--max-results", type=int, default=256, help="monthly tables kept in the result cache")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, GrowLightsAPI(args.cache_dir, args.max_results), args.verbose)
+    print(f"Serving on http://{server.server_address[0]}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,434 @@
+# PURPOSE #
+# Checks the array versions of the model stages against the original per-row loops (kept here as the reference)
+#   python -m pytest -q test_growlights.py
+import io
+import json
+import os
+import threading
+import tracemalloc
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import synthetic_raw, synthetic_weather
+from climate_store import ClimateStore
+from growlights import (LED_usage, Hybrid_usage, sweep_usage, optimize_setpoints, scenario_objectives, scenario_grid,
+                        AL_mask, SolarSummary, StageProfile, WeatherIndex)
+from schedule_io import iter_schedule_csv, write_schedule
+from server import GrowLightsAPI, make_server
+from weather_io import format_climatedata, read_climatedata
+
+def small_weather(days=4, seed=0):
+    # Hourly weather of a few days with missing Isun and Temp values, night hours (Isun = 0) and hot sunny hours
+    rng = np.random.default_rng(seed)
+    hours = np.tile(np.arange(24), days)
+    sun = np.clip(np.sin((hours - 6)/12*np.pi), 0, None)
+    weather = pd.DataFrame({
+        "Year": np.full(len(hours), 2020, dtype="int16"),
+        "Month": np.full(len(hours), 6, dtype="int8"),
+        "Day": np.repeat(np.arange(1, days + 1), 24).astype("int8"),
+        "Hour": hours.astype("int8"),
+        "Temp": rng.uniform(5, 35, len(hours)).round(1),
+        "Isun": (sun*rng.uniform(200, 900, len(hours))).round(1),
+    })
+    weather.loc[rng.choice(len(weather), 6, replace=False), "Isun"] = np.nan
+    weather.loc[rng.choice(len(weather), 6, replace=False), "Temp"] = np.nan
+    return weather
+
+# ---------- Reference loops ---------- #
+
+def reference_AL_on(weather, shade, start, duration, rad_setpoint, tempsetpoint):
+    # "AL On/Off" as computed by the original iterrows loop of LED_usage / Hybrid_usage
+    AL_on = []
+    for _, row in weather.iterrows():
+        hour = row["Hour"]
+        temp = row["Temp"]
+        Isun3 = 0.8*(1-shade)*row["Isun"]
+
+        if (hour >= start and hour < (start+duration+1)) and Isun3 < rad_setpoint and not (temp > tempsetpoint and Isun3 != 0):
+            AL_on.append(1)
+        else:
+            AL_on.append(0)
+    return np.array(AL_on)
+
+def reference_Hybrid(weather, shade, start, duration, rad_setpoint, day_tempsetpoint, night_tempsetpoint, DLI_target,
+                     AL_Intensity, LED_Intensity, LED_eff, HPS_Intensity, HPS_eff):
+    # Light1/Light2 and their PAR/Elec per hour as computed by the original iterrows loops of Hybrid_usage
+    weather = weather.copy()
+    k = 0.8*(1-shade)*0.5*4.6*3600/1000000
+    weather["PAR_Canopy"] = k*weather["Isun"].fillna(0)
+    weather["Natural DLI"] = weather.groupby(["Year", "Month", "Day"])["PAR_Canopy"].transform("sum")
+    weather["AL On/Off"] = reference_AL_on(weather, shade, start, duration, rad_setpoint, day_tempsetpoint)
+    weather["Max AL Hours"] = weather.groupby(["Year", "Month", "Day"])["AL On/Off"].transform("sum")
+    hours_needed = (DLI_target - weather["Natural DLI"])*1000000/AL_Intensity/3600
+    weather["Actual AL Hours"] = hours_needed.clip(lower=0, upper=weather["Max AL Hours"])
+
+    light1, light2 = [], []
+    current_key = None
+    used_hours = 0
+    for _, row in weather.iterrows():
+        key = (row["Year"], row["Month"], row["Day"])
+        if key != current_key:
+            current_key = key
+            used_hours = 0
+
+        temp = row["Temp"]
+        Isun3 = 0.8*(1-shade)*row["Isun"]
+        if int(row["AL On/Off"]) == 1 and used_hours < int(round(row["Actual AL Hours"])):
+            if Isun3 == 0:
+                light1.append("HPS" if temp < night_tempsetpoint else "LED")
+            else:
+                light1.append("HPS" if temp < day_tempsetpoint else "LED")
+            used_hours += 1
+        else:
+            light1.append("None")
+
+        if light1[-1] == "None":
+            light2.append("None")
+        elif light1[-1] == "HPS":
+            light2.append("LED" if HPS_Intensity < AL_Intensity else "None")
+        elif Isun3 == 0:
+            light2.append("HPS" if LED_Intensity < AL_Intensity and temp < night_tempsetpoint else "None")
+        else:
+            light2.append("HPS" if LED_Intensity < AL_Intensity and temp < day_tempsetpoint else "None")
+
+    PAR = {"None": np.nan, "LED": LED_Intensity*3600/1000000, "HPS": HPS_Intensity*3600/1000000}
+    Elec = {"None": np.nan, "LED": LED_Intensity/LED_eff/1000, "HPS": HPS_Intensity/HPS_eff/1000}
+    return pd.DataFrame({
+        "Light1": light1,
+        "Light2": light2,
+        "Light1 PAR": [PAR[t] for t in light1],
+        "Light2 PAR": [PAR[t] for t in light2],
+        "Light1 Elec": [Elec[t] for t in light1],
+        "Light2 Elec": [Elec[t] for t in light2],
+    })
+
+# ---------- AL eligibility ---------- #
+
+@pytest.mark.parametrize("shade, start, duration, rad_setpoint, tempsetpoint", [
+    (0.33, 5, 16, 300, 22),
+    (0.0, 0, 23, 500, 15),          # window up to start+duration+1 = 24 -> every hour
+    (0.5, 6, 0, 200, 30),           # duration 0: window [6, 7) -> hour 6 only
+    (1.0, 3, 10, 100, 22),          # full shade: inside radiation is 0, never too warm
+    (0.2, 20, 8, 0, 22),            # rad_setpoint 0: no hour is below the setpoint
+])
+def test_AL_on_matches_loop(shade, start, duration, rad_setpoint, tempsetpoint):
+    weather = small_weather()
+    _, schedule = LED_usage(weather, shade=shade, start=start, duration=duration, rad_setpoint=rad_setpoint,
+                            GH_tempsetpoint=tempsetpoint, hourly=True)
+    expected = reference_AL_on(weather, shade, start, duration, rad_setpoint, tempsetpoint)
+    np.testing.assert_array_equal(schedule["AL On/Off"].to_numpy(), expected)
+
+def test_AL_on_window_upper_bound():
+    # The window includes the hour start+duration (the original "< start+duration+1" test)
+    weather = small_weather(days=1)
+    weather["Isun"], weather["Temp"] = 0.0, 10.0
+    _, schedule = LED_usage(weather, start=5, duration=3, hourly=True)
+    assert schedule.loc[schedule["AL On/Off"] == 1, "Hour"].tolist() == [5, 6, 7, 8]
+
+def test_AL_on_missing_values():
+    # Comparisons with a missing Isun are False (never ON), a missing Temp is never "too warm"
+    weather = small_weather(days=1)
+    weather["Isun"], weather["Temp"] = 100.0, 10.0
+    weather.loc[10, "Isun"] = np.nan
+    weather.loc[11, "Temp"] = np.nan
+    _, schedule = LED_usage(weather, start=0, duration=23, rad_setpoint=300, GH_tempsetpoint=5, hourly=True)
+    on = schedule["AL On/Off"].to_numpy()
+    assert on[10] == 0 and on[11] == 1
+    np.testing.assert_array_equal(on, reference_AL_on(weather, 0.33, 0, 23, 300, 5))
+
+@pytest.mark.parametrize("shade, rad_setpoint", [
+    (0.0, 0), (0.0, 300), (0.33, 100), (0.5, 0), (0.5, 250),
+    (1.0, 0), (1.0, 250),           # full shade: inside radiation 0, below any positive setpoint
+    (0.27, 146), (0.3, 154),        # rad_setpoint/factor rounds past 250 / short of 275 (threshold_rank fix-ups)
+])
+def test_max_hours_matches_mask(shade, rad_setpoint):
+    # SolarSummary lookups equal the daily sums of the hourly mask: Isun in steps of 25 (0.4*625 == 250: ties on
+    # the setpoint), negative and missing values
+    weather = small_weather(days=6, seed=4)
+    rng = np.random.default_rng(4)
+    weather["Isun"] = weather["Isun"].where(weather["Isun"].isna(), 25.0*rng.integers(-2, 30, len(weather)))
+    index = WeatherIndex(weather)
+    for start, duration, tempsetpoint in [(5, 14, 22), (0, 23, 15)]:
+        mask = AL_mask(index.hour, index.temp, index.Isun, shade, start, duration, rad_setpoint, tempsetpoint)
+        expected = index.timestep*index.daily_sum(mask)
+        summary = SolarSummary(index, start, duration, tempsetpoint)
+        np.testing.assert_array_equal(summary.max_hours(shade, rad_setpoint), expected)
+        np.testing.assert_array_equal(summary.max_hours([shade, shade], [rad_setpoint, rad_setpoint]), np.column_stack([expected]*2))
+
+# ---------- Hybrid dispatch ---------- #
+
+@pytest.mark.parametrize("params", [
+    {},
+    {"LED_Intensity": 150, "HPS_Intensity": 250},           # HPS alone reaches the target: no Light2 behind it
+    {"shade": 0.6, "start": 0, "duration": 23, "DLI_target": 40, "night_tempsetpoint": 20},
+    {"AL_Intensity": 90, "rad_setpoint": 600},              # fixtures above the target: no Light2
+])
+def test_Hybrid_dispatch_matches_loop(params):
+    weather = small_weather()
+    params = {**dict(shade=0.33, start=5, duration=16, rad_setpoint=300, day_tempsetpoint=22, night_tempsetpoint=16,
+                     DLI_target=30, AL_Intensity=200, LED_Intensity=100, LED_eff=3.2, HPS_Intensity=100, HPS_eff=1.8), **params}
+    _, schedule = Hybrid_usage(weather, hourly=True, **params)
+    expected = reference_Hybrid(weather, **params)
+
+    np.testing.assert_array_equal(schedule["AL On/Off"].to_numpy(),
+                                  reference_AL_on(weather, *(params[k] for k in ("shade", "start", "duration", "rad_setpoint", "day_tempsetpoint"))))
+    for light in ("Light1", "Light2"):
+        assert schedule[light].astype(str).tolist() == expected[light].tolist()
+    for column in ("Light1 PAR", "Light2 PAR", "Light1 Elec", "Light2 Elec"):
+        np.testing.assert_allclose(schedule[column].to_numpy(), expected[column].to_numpy(), rtol=1e-12)
+
+# ---------- Scenario sweep ---------- #
+
+@pytest.mark.parametrize("system", ["LED", "Hybrid"])
+def test_sweep_matches_model_calls(system):
+    # Every scenario of a sweep equals its own model call, with day blocks that split the record (block_rows):
+    # windows with many shade x rad_setpoint values use the SolarSummary path, the last two the hourly mask
+    weather = synthetic_weather(2, seed=3)
+    scenarios = pd.concat([
+        scenario_grid(shade=[0.0, 0.2, 0.33, 0.5, 1.0], rad_setpoint=[0, 150, 300], start=[4, 6], DLI_target=[20, 30]),
+        scenario_grid(shade=[0.3], rad_setpoint=[250], start=[3, 7], DLI_target=[25]),
+    ], ignore_index=True)
+    fixed = {"AL_Intensity": 250} if system == "LED" else {"LED_Intensity": 150, "HPS_Intensity": 120}
+
+    monthly = sweep_usage(weather, scenarios, system=system, block_rows=1000, **fixed)
+    usage = LED_usage if system == "LED" else Hybrid_usage
+    for i, scenario in scenarios.iterrows():
+        expected = usage(weather, **scenario.to_dict(), **fixed)
+        got = monthly[monthly["Scenario"] == i][expected.columns].reset_index(drop=True)
+        pd.testing.assert_frame_equal(got, expected, check_dtype=False, rtol=1e-10)
+
+# ---------- Setpoint optimizer ---------- #
+
+@pytest.mark.parametrize("system, DLI_target, tolerance", [
+    ("LED", 12, 1), ("LED", 15, 1), ("LED", 20, 2), ("Hybrid", 12, 1), ("Hybrid", 20, 2), ("LED", 25, 0.5)
+])
+def test_optimizer_finds_cheapest_feasible(system, DLI_target, tolerance):
+    # "Best" is the lowest electricity of all feasible settings of a small grid, as from evaluating every setting
+    weather = synthetic_weather(2, seed=0)
+    index = WeatherIndex(weather)
+    params = {"start": np.arange(0, 24, 2), "duration": np.arange(2, 25, 2), "rad_setpoint": np.arange(0, 1001, 100)}
+    fixed = {} if system == "LED" else {"LED_Intensity": 150, "HPS_Intensity": 100}
+
+    grid = scenario_grid(**params)
+    monthly = sweep_usage(weather, grid, system=system, index=index, DLI_target=DLI_target, **fixed)
+    objectives = scenario_objectives(monthly, index, system, DLI_target, tolerance)
+    expected = objectives.loc[objectives["Feasible"], "Elec Cons (kWh/m2/yr)"]
+
+    result = optimize_setpoints(weather, system, DLI_target, tolerance, params=params, index=index, **fixed)
+    best = result[result["Best"]]
+    assert len(best) == min(len(expected), 1)
+    if len(expected):
+        assert best["Elec Cons (kWh/m2/yr)"].iloc[0] == pytest.approx(expected.min(), rel=1e-12)
+        assert best["Feasible"].iloc[0]
+
+# ---------- Row order ---------- #
+
+def quarter_hour_weather(days=3):
+    # 15 min weather: every hourly row of small_weather repeated at minutes 0, 15, 30 and 45
+    weather = small_weather(days).loc[lambda w: w.index.repeat(4)].reset_index(drop=True)
+    weather["Minute"] = np.tile([0, 15, 30, 45], len(weather)//4).astype("int8")
+    return weather
+
+@pytest.mark.parametrize("weather, reorder, timestep", [
+    (quarter_hour_weather(), lambda n: np.arange(n)[::-1], 0.25),
+    (small_weather(), lambda n: np.arange(n).reshape(-1, 24)[::-1, np.r_[0:24:2, 1:24:2]].ravel(), 1.0),
+], ids=["reversed 15 min", "shuffled hourly"])
+def test_row_order_does_not_change_results(weather, reorder, timestep):
+    # The timestep is inferred and the usage computed the same whatever the row order of the table
+    #   (shuffled hourly: days reversed, the even hours of a day before the odd ones -> 2 h steps in row order)
+    shuffled = weather.iloc[reorder(len(weather))].reset_index(drop=True)
+    assert WeatherIndex(weather).timestep == WeatherIndex(shuffled).timestep == timestep
+    pd.testing.assert_frame_equal(LED_usage(shuffled), LED_usage(weather))
+    pd.testing.assert_frame_equal(Hybrid_usage(shuffled), Hybrid_usage(weather))
+
+# ---------- Stage profiles ---------- #
+
+@pytest.mark.parametrize("run", [LED_usage, Hybrid_usage, optimize_setpoints,
+                                 lambda weather, **kw: sweep_usage(weather, scenario_grid(shade=[0.2, 0.3]), **kw)])
+def test_failed_run_stops_profile(run):
+    # A run that raises (no Temp column) still stops its StageProfile, so tracemalloc is not left on
+    weather = small_weather().drop(columns="Temp")
+    with pytest.raises(KeyError):
+        run(weather, profile=StageProfile())
+    assert StageProfile._tracing_users == 0
+    assert not tracemalloc.is_tracing()
+
+# ---------- Weather files ---------- #
+
+def raw_weather(rows=500):
+    # Raw rows as uploaded, with a missing radiation and a temperature that is not a number
+    raw = synthetic_raw(1, seed=5).iloc[:rows].copy()
+    raw["Temperature (C)"] = raw["Temperature (C)"].astype(object)
+    raw.loc[7, "Solar Radiation (W/m²)"] = np.nan
+    raw.loc[8, "Temperature (C)"] = "n/a"
+    return raw
+
+def write_raw(raw, path, kind):
+    if kind == "xlsx":
+        raw.to_excel(path, index=False)
+    elif kind == "csv":
+        raw.to_csv(path, index=False)
+    else:
+        raw.astype({c: str for c in ["Temperature (C)"] if c in raw}).to_parquet(path, index=False)
+
+@pytest.mark.parametrize("kind", ["xlsx", "csv", "parquet"])
+@pytest.mark.parametrize("chunk_size", [64, 50000])
+def test_read_climatedata_matches_format(tmp_path, kind, chunk_size):
+    # Streaming a file in chunks (64 rows -> many chunks) gives the same table as format_climatedata
+    raw = raw_weather()
+    path = tmp_path / f"weather.{kind}"
+    write_raw(raw, path, kind)
+    pd.testing.assert_frame_equal(read_climatedata(str(path), chunk_size=chunk_size), format_climatedata(raw))
+
+def test_read_climatedata_detected_time_format(tmp_path):
+    # String timestamps in another layout: the layout is detected from the first chunk
+    raw = raw_weather()
+    raw["Local Time"] = raw["Local Time"].dt.strftime("%m/%d/%Y %H:%M")
+    path = tmp_path / "weather.csv"
+    raw.to_csv(path, index=False)
+    pd.testing.assert_frame_equal(read_climatedata(str(path), chunk_size=64), format_climatedata(pd.read_csv(path)))
+
+@pytest.mark.parametrize("kind", ["xlsx", "csv", "parquet"])
+def test_read_climatedata_errors_match_format(tmp_path, kind):
+    raw = raw_weather(50)
+
+    missing = raw.drop(columns="Temperature (C)")
+    write_raw(missing, tmp_path / f"missing.{kind}", kind)
+    with pytest.raises(KeyError) as expected:
+        format_climatedata(missing)
+    with pytest.raises(KeyError) as got:
+        read_climatedata(str(tmp_path / f"missing.{kind}"), chunk_size=16)
+    assert str(got.value) == str(expected.value)
+
+    bad = raw.copy()
+    bad["Local Time"] = bad["Local Time"].astype(str)
+    bad.loc[30, "Local Time"] = "not a time"
+    write_raw(bad, tmp_path / f"bad.{kind}", kind)
+    with pytest.raises(ValueError) as expected:
+        format_climatedata(bad)
+    with pytest.raises(ValueError) as got:
+        read_climatedata(str(tmp_path / f"bad.{kind}"), chunk_size=16)
+    assert str(got.value) == str(expected.value)
+
+# ---------- Climate store ---------- #
+
+def test_climate_store_concurrent_writes(tmp_path):
+    # Writers of one site at the same time: none fails, the site holds one complete copy and no temporary folders remain
+    store = ClimateStore(str(tmp_path))
+    records = [synthetic_weather(1, seed=i) for i in range(6)]
+    errors = []
+
+    def write(i):
+        try:
+            for _ in range(3):
+                store.write("site", records[i], key=str(i))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(len(records))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert os.listdir(tmp_path) == ["site"]
+    key = store.info("site")["key"]
+    assert store.holds("site", key) and not store.holds("site", "other") and not store.holds("unknown", key)
+    expected = records[int(key)]
+    pd.testing.assert_frame_equal(store.load("site")[expected.columns].copy(), expected, check_dtype=False)
+
+# ---------- Server ---------- #
+
+@pytest.fixture
+def server(tmp_path):
+    # server.py on a free localhost port, with its own weather cache; yields its base URL
+    httpd = make_server(port=0, api=GrowLightsAPI(str(tmp_path / "cache")))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def call(url, body=None, data=None):
+    # POST a JSON body (or raw bytes), GET without either -> (status, response bytes)
+    if body is not None:
+        data = json.dumps(body).encode("utf-8")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data)) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def uploaded(server, tmp_path):
+    # Uploads a month of raw weather as CSV -> (weather hash, cleaned weather as the server reads it)
+    path = tmp_path / "site.csv"
+    synthetic_raw(1, seed=2).iloc[:24*31].to_csv(path, index=False)
+    status, body = call(f"{server}/weather?name=site.csv", data=path.read_bytes())
+    assert status == 200
+    return json.loads(body)["weather"], read_climatedata(str(path))
+
+def monthly_table(answer, expected):
+    return pd.DataFrame(answer["monthly"]).astype({"Month": expected["Month"].dtype})
+
+def test_server_upload_and_usage(server, tmp_path):
+    key, weather = uploaded(server, tmp_path)
+    status, body = call(f"{server}/weather/{key}")
+    assert status == 200 and json.loads(body) == {"weather": key, "rows": len(weather), "days": 31, "timestep": 1.0}
+
+    status, body = call(f"{server}/usage", {"weather": key, "system": "Hybrid", "params": {"shade": 0.3}})
+    assert status == 200
+    answer = json.loads(body)
+    expected = Hybrid_usage(weather, shade=0.3)
+    assert not answer["cached"] and answer["params"]["shade"] == 0.3
+    pd.testing.assert_frame_equal(monthly_table(answer, expected), expected, rtol=1e-12)
+
+def test_server_usage_batch(server, tmp_path):
+    # Valid requests of a batch are answered (two LED ones in one sweep) next to the failed ones, in request order
+    key, weather = uploaded(server, tmp_path)
+    requests = [
+        {"weather": key, "params": {"shade": 0.2}},
+        {"weather": "../../etc/passwd"},
+        {"weather": key, "params": {"shade": float("nan")}},
+        {"weather": "0"*64},
+        {"weather": key, "params": {"shade": 0.4, "DLI_target": 20}},
+    ]
+    status, body = call(f"{server}/usage", {"requests": requests})
+    assert status == 200
+    results = json.loads(body)["results"]
+    assert [r.get("status") for r in results] == [None, 400, 400, 404, None]
+    for i in (0, 4):
+        expected = LED_usage(weather, **requests[i]["params"])
+        pd.testing.assert_frame_equal(monthly_table(results[i], expected), expected, rtol=1e-10)
+
+def test_server_usage_cache(server, tmp_path):
+    # A repeated request is answered from the result cache, also when a parameter is written differently
+    key, _ = uploaded(server, tmp_path)
+    first = json.loads(call(f"{server}/usage", {"weather": key, "params": {"start": 5}})[1])
+    second = json.loads(call(f"{server}/usage", {"weather": key, "params": {"start": "5.0"}})[1])
+    third = json.loads(call(f"{server}/usage", {"weather": key})[1])
+    assert not first["cached"] and second["cached"] and third["cached"]
+    assert second["monthly"] == first["monthly"] == third["monthly"]
+
+@pytest.mark.parametrize("kind", ["csv", "parquet"])
+def test_server_schedule(server, tmp_path, kind):
+    # The streamed schedule is the file schedule_io writes for the same model call
+    key, weather = uploaded(server, tmp_path)
+    status, body = call(f"{server}/schedule", {"weather": key, "params": {"shade": 0.25}, "format": kind})
+    assert status == 200
+
+    _, schedule = LED_usage(weather, shade=0.25, hourly="compact")
+    if kind == "csv":
+        expected = b"".join(iter_schedule_csv(schedule))
+        read = lambda data: pd.read_csv(io.BytesIO(data))
+    else:
+        buffer = io.BytesIO()
+        write_schedule(schedule, buffer, kind)
+        expected = buffer.getvalue()
+        read = lambda data: pd.read_parquet(io.BytesIO(data))
+    pd.testing.assert_frame_equal(read(body), read(expected))
+    assert len(read(body)) == len(weather)
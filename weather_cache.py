@@ -0,0 +1,113 @@
+# PURPOSE #
+# Keeps cleaned weather tables (output of format_climatedata) so an unchanged upload is not parsed again.
+#   Tables are keyed on a hash of the uploaded file bytes and kept
+#     1) in memory, for the most recently used uploads (bounded, least recently used are evicted)
+#     2) on disk as Parquet files, so later sessions and reruns skip the Excel parsing (bounded, oldest are removed)
+#   The same table is handed to every session, it must be treated as read-only (the models do not modify it)
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+class WeatherCache:
+
+    def __init__(self, cache_dir=".weather_cache", max_entries=8, max_files=64):
+        # cache_dir: folder for the Parquet files (None -> memory only)
+        # max_entries: number of weather tables kept in memory
+        # max_files: number of Parquet files kept on disk
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(data):
+        # Content hash of the uploaded bytes
+        return hashlib.sha256(data).hexdigest()
+
+    def load(self, data, parse, key=None):
+        # Returns the cleaned weather table for the uploaded bytes
+        #   parse(data) is only called when the table is neither in memory nor on disk
+        #   key: content hash of data, if the caller already has it
+        key = self.key(data) if key is None else key
+
+        weather = self.get(key)
+        if weather is None:
+            weather = parse(data)
+            self.put(key, weather)
+
+        return weather
+
+    def get(self, key):
+        # Returns the cached table for a content hash (None if it is not cached)
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                return self._tables[key]
+
+        path = self._path(key)
+        if path is None or not os.path.exists(path):
+            return None
+
+        try:
+            weather = pd.read_parquet(path)
+            os.utime(path)                        # mark as recently used for the file eviction
+        except FileNotFoundError:                 # evicted by another process in the meantime
+            return None
+        self._remember(key, weather)
+        return weather
+
+    def put(self, key, weather):
+        # Stores a cleaned table in memory and on disk
+        self._remember(key, weather)
+
+        path = self._path(key)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            #   each writer has its own temporary file, other sessions never see a half written file
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{key}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    weather.to_parquet(f, index=False)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            self._evict_files()
+
+    def _remember(self, key, weather):
+        with self._lock:
+            self._tables[key] = weather
+            self._tables.move_to_end(key)
+            while len(self._tables) > self.max_entries:
+                self._tables.popitem(last=False)
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _evict_files(self):
+        # Removes the least recently used Parquet files above max_files
+        #   files removed by another process while listing are skipped
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".parquet"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    pass
+        if len(files) <= self.max_files:
+            return
+
+        files.sort()
+        for _, path in files[:len(files) - self.max_files]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
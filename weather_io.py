@@ -0,0 +1,161 @@
+# PURPOSE #
+# Turns raw weather files into the cleaned table used by the models (hourly or finer, e.g. every 5 or 15 minutes):
+#   Year (int16), Month/Day/Hour/Minute (int8), Temp (C), Isun (W/m2)
+#   format_climatedata cleans a table that is already loaded, read_climatedata streams a file (xlsx, csv or parquet)
+#   in chunks so only the compact columns are kept in memory
+import os
+
+import pandas as pd
+
+REQUIRED_COLUMNS = [
+    "Local Time",
+    "Temperature (C)",
+    "Solar Radiation (W/m²)"
+]
+
+# Timestamp layouts tried (in order) when no time_format is given
+TIME_FORMATS = [
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d %H:%M",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y %H:%M",
+    "%m/%d/%Y %I:%M %p",
+    "%d.%m.%Y %H:%M",
+]
+
+# ---------- Cleaning ---------- #
+
+def check_columns(columns):
+    missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+    if missing:
+        raise KeyError(f"Missing required columns: {missing}")
+
+def detect_time_format(times):
+    # Returns the first layout in TIME_FORMATS that parses a sample of the timestamps (None -> no fixed layout)
+    sample = pd.Series(times).dropna().head(100)
+    if sample.empty or not all(isinstance(t, str) for t in sample):
+        return None
+
+    for fmt in TIME_FORMATS:
+        try:
+            pd.to_datetime(sample, format=fmt)
+            return fmt
+        except (ValueError, TypeError):
+            continue
+    return None
+
+def clean_chunk(times, temps, radiation, time_format=None):
+    # Cleans one block of raw rows into the compact weather columns
+
+    dt = pd.to_datetime(pd.Series(times), errors="coerce", utc=False, format=time_format)
+    if dt.isna().any():
+        raise ValueError("Some 'Local Time' values could not be parsed as datetimes.")
+
+    clean_data = pd.DataFrame({
+        "Year": dt.dt.year.astype("int16"),
+        "Month": dt.dt.month.astype("int8"),
+        "Day": dt.dt.day.astype("int8"),
+        "Hour": dt.dt.hour.astype("int8"),
+        "Minute": dt.dt.minute.astype("int8"),
+        "Temp": pd.to_numeric(pd.Series(temps), errors="coerce"),
+        "Isun": pd.to_numeric(pd.Series(radiation), errors="coerce")
+    })
+
+    if clean_data[["Year", "Month", "Day", "Hour", "Minute"]].isna().any().any():
+        raise ValueError("Year/Month/Day/Hour/Minute could not be derived from 'Local Time'.")
+
+    return clean_data
+
+def format_climatedata(raw_data):
+
+    check_columns(raw_data.columns)
+
+    return clean_chunk(
+        raw_data["Local Time"],
+        raw_data["Temperature (C)"],
+        raw_data["Solar Radiation (W/m²)"]
+    )
+
+# ---------- Streaming readers ---------- #
+
+def file_kind(name):
+    # "xlsx", "csv" or "parquet" from a file name
+    kind = os.path.splitext(name)[1].lower().lstrip(".")
+    if kind not in ("xlsx", "csv", "parquet"):
+        raise ValueError(f"Unsupported weather file type: '{name}' (use xlsx, csv or parquet)")
+    return kind
+
+def iter_raw_xlsx(source, chunk_size):
+    # Yields blocks of (Local Time, Temperature, Solar Radiation) from the first sheet (openpyxl read-only mode)
+    import openpyxl
+
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = [str(c) if c is not None else "" for c in next(rows, ())]
+        check_columns(header)
+        cols = [header.index(c) for c in REQUIRED_COLUMNS]
+
+        block = []
+        for row in rows:
+            values = [row[i] if i < len(row) else None for i in cols]
+            if all(v is None for v in values):
+                continue                # empty rows are skipped, as pd.read_excel does at the end of a sheet
+            block.append(values)
+            if len(block) == chunk_size:
+                yield pd.DataFrame(block, columns=REQUIRED_COLUMNS)
+                block = []
+        if block:
+            yield pd.DataFrame(block, columns=REQUIRED_COLUMNS)
+    finally:
+        wb.close()
+
+def iter_raw_csv(source, chunk_size):
+    header = pd.read_csv(source, nrows=0).columns
+    check_columns(header)
+    if hasattr(source, "seek"):
+        source.seek(0)
+
+    yield from pd.read_csv(source, usecols=REQUIRED_COLUMNS, dtype={"Local Time": str}, chunksize=chunk_size)
+
+def iter_raw_parquet(source, chunk_size):
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(source)
+    check_columns(parquet.schema_arrow.names)
+
+    for batch in parquet.iter_batches(batch_size=chunk_size, columns=REQUIRED_COLUMNS):
+        yield batch.to_pandas()
+
+def iter_climatedata(source, kind=None, chunk_size=50000, time_format=None):
+    # Yields the cleaned weather table block by block
+    #   source: path or file-like object, kind: "xlsx", "csv" or "parquet" (taken from the file name if not given)
+    #   time_format: strftime layout of "Local Time" (detected from the first block if not given)
+    if kind is None:
+        kind = file_kind(getattr(source, "name", source))
+
+    readers = {"xlsx": iter_raw_xlsx, "csv": iter_raw_csv, "parquet": iter_raw_parquet}
+    detect = time_format is None
+
+    for raw in readers[kind](source, chunk_size):
+        if detect:
+            time_format = detect_time_format(raw["Local Time"])
+            detect = False
+        yield clean_chunk(
+            raw["Local Time"].to_numpy(),
+            raw["Temperature (C)"].to_numpy(),
+            raw["Solar Radiation (W/m²)"].to_numpy(),
+            time_format
+        )
+
+def read_climatedata(source, kind=None, chunk_size=50000, time_format=None):
+    # Streams a weather file into the cleaned weather table (same columns and errors as format_climatedata)
+    chunks = list(iter_climatedata(source, kind, chunk_size, time_format))
+    if not chunks:
+        return clean_chunk([], [], [])
+
+    clean_data = pd.concat(chunks, ignore_index=True)
+    clean_data[["Temp", "Isun"]] = clean_data[["Temp", "Isun"]].astype("float64")
+    return clean_data